@@ -0,0 +1,172 @@
+"""
+Billing preview: evaluates the next billing run without creating anything.
+It reads the same billable services the run would invoice and works out the
+lines in memory, so it never touches Sales Invoice, GL or the billing ledger
+and is safe to run during business hours.
+"""
+
+import csv
+from io import StringIO
+
+import frappe
+from frappe.utils import cint, flt, nowdate
+from werkzeug.wrappers import Response
+
+from isp_billing.api.sales_invoice import get_billable_services
+from isp_billing.isp_billing.doctype.gocardless_mandates.gocardless_mandates import (
+	DEAD_MANDATE_STATUSES,
+	SUSPENDED_MANDATE_STATUSES,
+)
+from isp_billing.isp_billing.doctype.subscription_service.subscription_service import (
+	get_billing_period_end,
+	get_billing_period_start,
+)
+
+PREVIEW_COLUMNS = (
+	"subscription",
+	"customer",
+	"service",
+	"plan",
+	"item",
+	"quantity",
+	"price",
+	"amount",
+	"currency",
+	"payment_method",
+	"period_start",
+	"period_end",
+	"billing_date",
+)
+
+
+def get_payment_method(svc):
+	"""How the invoice for a service row will be collected"""
+	if svc.mandate_id and svc.mandate_status in SUSPENDED_MANDATE_STATUSES:
+		# stays the customer's mandate, but is not charged until the payer reinstates it
+		return "GoCardless (suspended)"
+	if svc.mandate_id and svc.mandate_status not in DEAD_MANDATE_STATUSES:
+		return "GoCardless"
+	if svc.stripe_payment_method:
+		return "Stripe"
+	return "Manual"
+
+
+def get_preview_lines(billing_date=None, subscriptions=None):
+	"""
+	One line per service row the billing run would invoice on billing_date.
+	The database is read up front; the lines themselves are worked out lazily
+	and need no database, so they can be consumed after the request is over.
+	"""
+
+	default_currency = frappe.db.get_default("currency")
+	services = get_billable_services(subscriptions, billing_date=billing_date)
+
+	return (get_preview_line(svc, default_currency) for svc in services)
+
+
+def get_preview_line(svc, default_currency=None):
+	period_start = get_billing_period_start(svc)
+
+	return frappe._dict(
+		{
+			"subscription": svc.subscription,
+			"customer": svc.customer,
+			"service": svc.service,
+			"plan": svc.plan_name or svc.plan,
+			"item": svc.item,
+			"quantity": flt(svc.quantity),
+			"price": flt(svc.price),
+			"amount": flt(svc.quantity) * flt(svc.price),
+			"currency": svc.currency or default_currency,
+			"payment_method": get_payment_method(svc),
+			"period_start": period_start,
+			"period_end": get_billing_period_end(svc, period_start),
+			"billing_date": svc.next_billing_date,
+		}
+	)
+
+
+@frappe.whitelist()
+def preview_billing(billing_date=None):
+	"""
+	Totals of the invoices the next run would raise, per plan, currency and
+	payment method. Nothing is inserted or submitted.
+	"""
+
+	billing_date = billing_date or nowdate()
+	consolidate = cint(frappe.db.get_single_value("Isp Billing Setting", "consolidate_invoices"))
+
+	totals = {}
+	invoices = set()
+	lines = 0
+
+	for line in get_preview_lines(billing_date):
+		lines += 1
+		# 🔹 Same grouping as invoice_billable_services: one invoice per customer or per row
+		invoices.add(line.customer if consolidate else line.service)
+
+		key = (line.plan, line.currency, line.payment_method)
+		row = totals.setdefault(
+			key,
+			{
+				"plan": line.plan,
+				"currency": line.currency,
+				"payment_method": line.payment_method,
+				"services": 0,
+				"amount": 0.0,
+			},
+		)
+		row["services"] += 1
+		row["amount"] += line.amount
+
+	by_currency = {}
+	for row in totals.values():
+		by_currency[row["currency"]] = by_currency.get(row["currency"], 0.0) + row["amount"]
+
+	return {
+		"success": True,
+		"billing_date": billing_date,
+		"consolidated": bool(consolidate),
+		"invoices": len(invoices),
+		"services": lines,
+		"total_by_currency": by_currency,
+		"totals": sorted(
+			totals.values(), key=lambda row: (row["currency"], row["plan"], row["payment_method"])
+		),
+	}
+
+
+def iter_preview_csv(lines):
+	"""Yield preview lines as CSV text, one row at a time"""
+
+	buffer = StringIO()
+	writer = csv.writer(buffer)
+
+	def flush():
+		value = buffer.getvalue()
+		buffer.seek(0)
+		buffer.truncate(0)
+		return value
+
+	writer.writerow(PREVIEW_COLUMNS)
+	yield flush()
+
+	for line in lines:
+		writer.writerow([line[column] for column in PREVIEW_COLUMNS])
+		yield flush()
+
+
+@frappe.whitelist()
+def download_billing_preview(billing_date=None):
+	"""
+	Line-level billing preview as a CSV download. The rows are streamed to the
+	client as they are written instead of building the whole file in memory.
+	"""
+
+	billing_date = billing_date or nowdate()
+
+	return Response(
+		iter_preview_csv(get_preview_lines(billing_date)),
+		mimetype="text/csv",
+		headers={"Content-Disposition": f'attachment; filename="billing-preview-{billing_date}.csv"'},
+	)
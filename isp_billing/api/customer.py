@@ -104,6 +104,20 @@ def get_customer_name_by_email(email):
 
 
 
+def get_email_key(email):
+    """Normalised form of an email address, used to match customers across systems"""
+    return (email or "").strip().lower() or None
+
+
+def set_email_key(doc, method=None):
+    """Keep the indexed custom_email_key in step with custom_email"""
+    doc.custom_email_key = get_email_key(doc.custom_email)
+
+
+
+
+
+
 def create_portal_user(doc, method):
     """Create portal user when a Customer is created."""
 
@@ -1,9 +1,34 @@
 import hmac
 import json
+import time
 import frappe
 import hashlib
+import threading
 import gocardless_pro
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from frappe.query_builder import DocType
+from gocardless_pro.api_client import ApiClient
+from gocardless_pro.rate_limit import update_rate_limit
+from requests.adapters import HTTPAdapter
+
+from isp_billing.api.payment_preflight import get_charge_instructions, get_payment_idempotency_key
+from isp_billing.api.sales_invoice import (
+    billing_lock,
+    get_billable_services,
+    invoice_billable_services,
+    run_billing_shard,
+)
+from isp_billing.isp_billing.doctype.billing_run.billing_run import get_billing_run
+from isp_billing.isp_billing.doctype.gocardless_mandates.gocardless_mandates import MANDATE_ACTION_STATUSES
+from isp_billing.isp_billing.doctype.gocardless_webhook_event.gocardless_webhook_event import (
+    get_last_applied,
+    get_pending_events,
+    insert_webhook_events,
+    set_event_status,
+)
 
 
 
@@ -14,18 +39,97 @@ def get_gocardless_access_token():
 
 
 
+"""
+Shared GoCardless client: one per worker process and site, reusing a pooled
+keep-alive HTTP session, so consecutive API calls skip the TLS handshake.
+"""
+
+# seconds to connect / to wait for a response from the GoCardless API
+GOCARDLESS_TIMEOUT = (5, 30)
+
+_gocardless_clients = {}
+
+
+class PooledApiClient(ApiClient):
+    """gocardless_pro ApiClient that sends every request through one requests.Session"""
+
+    def __init__(self, base_url, access_token, session):
+        super().__init__(base_url, access_token)
+        self.session = session
+
+    def _request(self, method, path, **kwargs):
+        response = self.session.request(
+            method,
+            self._url_for(path),
+            timeout=GOCARDLESS_TIMEOUT,
+            **kwargs
+        )
+        self._handle_errors(response)
+        return response
+
+    @update_rate_limit
+    def get(self, path, params=None, headers=None):
+        return self._request("GET", path, params=params, headers=self._headers(headers))
+
+    @update_rate_limit
+    def post(self, path, body, headers=None):
+        return self._request("POST", path, data=json.dumps(body), headers=self._headers(headers))
+
+    @update_rate_limit
+    def put(self, path, body, headers=None):
+        return self._request("PUT", path, data=json.dumps(body), headers=self._headers(headers))
+
+    @update_rate_limit
+    def delete(self, path, body, headers=None):
+        return self._request("DELETE", path, data=json.dumps(body), headers=self._headers(headers))
+
+
+def get_gocardless_client():
+    """
+    Return the GoCardless client for the current site, built from Isp Billing
+    Setting. It is cached per process and rebuilt when the access token,
+    environment or base URL changes.
+    """
+
+    settings = frappe.get_cached_doc("Isp Billing Setting")
+    environment = settings.gocardless_environment or "sandbox"
+    # site_config override, e.g. to point a scratch site at the benchmark gateway stub
+    base_url = frappe.conf.get("isp_billing_gocardless_base_url")
+    key = (settings.access_token, environment, base_url)
+
+    cached = _gocardless_clients.get(frappe.local.site)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    if cached:
+        cached[1]._api_client.session.close()
+
+    client = gocardless_pro.Client(access_token=settings.access_token, environment=environment, base_url=base_url)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=20)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    client._api_client = PooledApiClient(client._api_client.base_url, settings.access_token, session)
+
+    _gocardless_clients[frappe.local.site] = (key, client)
+    return client
+
+
+def clear_gocardless_client():
+    """Drop the cached client of the current site, e.g. after Isp Billing Setting is saved"""
+    cached = _gocardless_clients.pop(frappe.local.site, None)
+    if cached:
+        cached[1]._api_client.session.close()
+
+
+
 
 
 @frappe.whitelist(allow_guest=True)
 def gocardless_test():
 
-    access_token = get_gocardless_access_token()
-    token = access_token.get("access_token")
-
-    client = gocardless_pro.Client(
-        access_token=token,
-        environment="sandbox",
-    )
+    client = get_gocardless_client()
 
     customers = client.customers.list().records
     print("Customers" , customers)
@@ -64,14 +168,7 @@ def gocardless_test():
 # Create Customer, customer mandate and bank details of customer
 def create_customer_and_mandate(first_name, last_name, email, address, city, postal_code, country_code):
 
-    access_token = get_gocardless_access_token()
-    token = access_token.get("access_token")
-
-    # Initialize the GoCardless client
-    client = gocardless_pro.Client(
-        access_token=token,
-        environment="sandbox"
-    )
+    client = get_gocardless_client()
 
     # Define customer parameters
     customer_params = {
@@ -136,14 +233,7 @@ def create_customer_and_mandate(first_name, last_name, email, address, city, pos
 # add subscription for specific mandate
 def create_subscription(mandate_id: str):
 
-    access_token = get_gocardless_access_token()
-    token = access_token.get("access_token")
-
-    # Initialize the GoCardless client
-    client = gocardless_pro.Client(
-        access_token=token,
-        environment="sandbox"
-    )
+    client = get_gocardless_client()
 
     try:
         # Define subscription parameters
@@ -181,14 +271,7 @@ def create_subscription(mandate_id: str):
 def get_subscriptions_by_mandate(mandate_id: str):
     """Fetch all subscriptions linked to a mandate"""
     try:
-        access_token = get_gocardless_access_token()
-        token = access_token.get("access_token")
-
-        # Initialize GoCardless client
-        client = gocardless_pro.Client(
-            access_token=token,
-            environment="sandbox"  # change to 'live' in production
-        )
+        client = get_gocardless_client()
 
         # List subscriptions filtered by mandate
         subscriptions = client.subscriptions.list(params={
@@ -227,13 +310,7 @@ def get_subscriptions_by_mandate(mandate_id: str):
 # invite customer link
 def create_customer_invite_link(first_name, last_name, email):
 
-    access_token = get_gocardless_access_token()
-    token = access_token.get("access_token")
-
-    client = gocardless_pro.Client(
-        access_token=token,
-        environment="sandbox"
-    )
+    client = get_gocardless_client()
 
     redirect_flow = client.redirect_flows.create(params={
         "description": "CLI Secure Direct Debit Setup",
@@ -255,13 +332,7 @@ def create_customer_invite_link(first_name, last_name, email):
 
 def complete_redirect_flow(redirect_flow_id, session_token):
 
-    access_token = get_gocardless_access_token()
-    token = access_token.get("access_token")
-
-    client = gocardless_pro.Client(
-        access_token=token,
-        environment="sandbox"
-    )
+    client = get_gocardless_client()
 
     completed_flow = client.redirect_flows.complete(
         redirect_flow_id,
@@ -292,175 +363,348 @@ this code is used in gocardless webhook
 def gocardless_webhook():
     """
     Webhook endpoint for GoCardless.
-    This will be called by GoCardless when events (like new customer created) happen.
+    Only verifies the signature and stores the raw events; they are processed
+    by a background job, so the response time does not depend on the batch size.
     """
 
-    access_token = get_gocardless_access_token()
-    token = access_token.get("access_token")
+    payload = frappe.request.data.decode("utf-8")
+    signature = frappe.get_request_header("Webhook-Signature")
 
+    # ✅ Verify signature, GoCardless expects 498 for an invalid one
+    if not signature or not verify_webhook_signature(payload, signature):
+        frappe.local.response["http_status_code"] = 498
+        return "Invalid Webhook Signature"
 
-    try:
-        # Read request body
-        payload = frappe.request.data.decode("utf-8")
-        signature = frappe.get_request_header("Webhook-Signature")
-
-        # ✅ Verify signature
-        if not verify_webhook_signature(payload, signature):
-            frappe.throw("Invalid Webhook Signature")
-
-        data = json.loads(payload)
-
-        # ✅ Loop through events
-        for event in data.get("events", []):
-            event_type = event.get("resource_type")
-            action = event.get("action")
-
-            if event_type == "customers":
-                customer_id = event.get("links", {}).get("customer")
-
-                # Fetch full customer details
-                client = gocardless_pro.Client(
-                    # access_token=frappe.db.get_single_value("GoCardless Settings", "access_token"),
-                    access_token=token,
-                    environment="sandbox"  # change to "live" in production
-                )
-
-                customer = client.customers.get(customer_id)
-
-                frappe.logger().info(f"New Customer Created: {customer}")
-
-                # Save customer in a custom Doctype (example: GoCardless Customer)
-                doc = frappe.get_doc({
-                    "doctype": "GoCardless Customer",
-                    "customer_id": customer.id,
-                    "email": customer.email,
-                    "given_name": customer.given_name,
-                    "family_name": customer.family_name
-                })
-                doc.insert(ignore_permissions=True)
-
-            elif event_type == "mandates" and action == "created":
-                mandate_id = event.get("links", {}).get("mandate")
-
-                # Save mandate
-                frappe.logger().info(f"New Mandate Created: {mandate_id}")
-
-                doc = frappe.get_doc({
-                    "doctype": "GoCardless Mandates",
-                    "mandate_id": mandate_id,
-                    "status": event.get("details", {}).get("cause", "pending")
-                })
-                doc.insert(ignore_permissions=True)
-            elif event_type == "payments" and action == "created":
-                payment_id = event.get("links", {}).get("payment")
-
-                # ✅ Get full payment details using your existing function
-                payment_details = get_gocardless_payment_details(payment_id)
-
-                frappe.logger().info(f"New Payment Created: {payment_details}")
-
-                # ✅ Extract ERPNext Sales Invoice ID from metadata
-                invoice_id = payment_details.get("invoice_detail", {}).get("erpnext_invoice")
-
-                if invoice_id:
-                    try:
-                        # Fetch Sales Invoice
-                        si = frappe.get_doc("Sales Invoice", invoice_id)
-
-                        # Update custom fields
-                        si.db_set("custom_gocardless_payment_id", payment_details.get("payment_id"))
-                        si.db_set("custom_gocardless_payment_status", payment_details.get("status"))
-
-                        frappe.logger().info(f"Updated Sales Invoice {invoice_id} with GoCardless payment details")
-
-                    except Exception as e:
-                        frappe.log_error(frappe.get_traceback(), f"Error updating Sales Invoice {invoice_id} with GoCardless Payment")
-
-            elif event_type == "payments":
-                payment_id = event.get("links", {}).get("payment")
-
-                # ✅ Get latest payment details
-                payment_details = get_gocardless_payment_details(payment_id)
-
-                frappe.logger().info(f"Payment Event Received: {payment_details}")
-
-                try:
-                    # Find Sales Invoice using custom_gocardless_payment_id
-                    si_name = frappe.db.get_value("Sales Invoice", {"custom_gocardless_payment_id": payment_id}, "name")
-                    if si_name:
-                        # ✅ 1) Always update status first
-                        frappe.db.set_value("Sales Invoice", si_name, "custom_gocardless_payment_status", payment_details.get("status"))
-                        frappe.logger().info(f"Updated Sales Invoice {si_name} status to {payment_details.get('status')}")
-
-                        # ✅ 2) If status is "paid_out" → Create Payment Entry
-                        if payment_details.get("status") == "paid_out":
-                            si = frappe.get_doc("Sales Invoice", si_name)
-                            # print("psyment intent status", payment_intent.status)
-                            payment_confirmation = frappe.get_doc("Email Template", "Payment Confirmation")
-
-                            context = {
-                                "customer": customer.name,
-                                "amount": si.outstanding_amount,
-                                "invoice_number": si.name
-                            }
-
-                            subject = frappe.render_template(payment_confirmation.subject, context)
-                            message = frappe.render_template(payment_confirmation.response, context)
-
-                            frappe.sendmail(
-                                recipients=customer.custom_email,
-                                subject=subject,
-                                message=message
-                            )
-
-                            # Avoid duplicate Payment Entries
-                            # existing_pe = frappe.db.exists(
-                            #     "Payment Entry",
-                            #     {
-                            #         "reference_no": payment_id,
-                            #         "party_type": "Customer",
-                            #         "party": si.customer
-                            #     }
-                            # )
-
-                            # if not existing_pe:
-                            #     pe = frappe.get_doc({
-                            #         "doctype": "Payment Entry",
-                            #         "payment_type": "Receive",
-                            #         "company": si.company,
-                            #         "posting_date": frappe.utils.nowdate(),
-                            #         "party_type": "Customer",
-                            #         "party": si.customer,
-                            #         # "paid_from": frappe.get_value("Company", si.company, "1310 - Debtors - CLI SECURE"),
-                            #         "paid_from": frappe.get_value("Company", si.company, "Debtors - CS"),
-                            #         # "paid_to": frappe.get_value("Company", si.company, "GoCardless-DIRECT DEBIT - GoCardless - CLI SECURE"),
-                            #         "paid_to": frappe.get_value("Company", si.company, "Cash - CS"),
-                            #         "paid_amount": si.outstanding_amount,
-                            #         "received_amount": si.outstanding_amount,
-                            #         "reference_no": payment_id,
-                            #         "reference_date": frappe.utils.nowdate(),
-                            #         "references": [{
-                            #             "reference_doctype": "Sales Invoice",
-                            #             "reference_name": si.name,
-                            #             "allocated_amount": si.outstanding_amount
-                            #         }]
-                            #     })
-                            #     pe.insert(ignore_permissions=True)
-                            #     pe.submit()
-
-                            #     frappe.logger().info(f"✅ Payment Entry {pe.name} created for Sales Invoice {si.name}")
-                            # else:
-                            #     frappe.logger().info(f"ℹ️ Payment Entry already exists for Sales Invoice {si_name} and Payment {payment_id}")
-
-                except Exception as e:
-                    frappe.log_error(frappe.get_traceback(), f"Error handling Payment {payment_id}")
-
-
-        return "Webhook received"
+    events = json.loads(payload).get("events", [])
+
+    # ✅ Redelivered events hit the unique event id and are skipped
+    insert_webhook_events(events)
+    enqueue_gocardless_event_processing()
+
+    return "Webhook received"
+
+
+
+def enqueue_gocardless_event_processing():
+    frappe.enqueue(
+        "isp_billing.api.gocardless.process_gocardless_webhook_events",
+        queue="short",
+        job_id="isp_billing_gocardless_webhook_events",
+        deduplicate=True,
+        enqueue_after_commit=True
+    )
+
+
+
+def process_gocardless_webhook_events():
+    """
+    Background job: handle every pending GoCardless Webhook Event, oldest first.
+    Payment and mandate events of a batch are resolved and written together,
+    everything else one event at a time. Also runs hourly to pick up events whose job
+    was lost.
+    """
+
+    while True:
+        events = get_pending_events()
+        if not events:
+            break
+
+        # 🔹 Payment and mandate events are applied per resource type in bulk
+        for resource_type, apply_events in (
+            ("payments", apply_gocardless_payment_events),
+            ("mandates", apply_gocardless_mandate_events),
+        ):
+            batch = [event for event in events if event.resource_type == resource_type]
+            if not batch:
+                continue
+
+            try:
+                apply_events(batch)
+            except Exception:
+                frappe.db.rollback()
+                frappe.log_error(frappe.get_traceback(), f"GoCardless {resource_type} events failed")
+                set_event_status([event.name for event in batch], "Failed", frappe.get_traceback())
+            else:
+                set_event_status([event.name for event in batch], "Processed")
+
+            frappe.db.commit()
+
+        for event in events:
+            if event.resource_type in ("payments", "mandates"):
+                continue
+
+            try:
+                handle_gocardless_event(json.loads(event.payload))
+            except Exception:
+                frappe.db.rollback()
+                frappe.log_error(frappe.get_traceback(), f"GoCardless Webhook Event {event.name} failed")
+                set_event_status([event.name], "Failed", frappe.get_traceback())
+            else:
+                set_event_status([event.name], "Processed")
+
+            frappe.db.commit()
+
+
+
+# GoCardless payment status after each payment event action. Actions that are
+# not listed do not imply a status, so the payment is fetched instead.
+PAYMENT_ACTION_STATUSES = {
+    "created": "pending_submission",
+    "customer_approval_granted": "pending_submission",
+    "customer_approval_denied": "customer_approval_denied",
+    "resubmission_requested": "pending_submission",
+    "submitted": "submitted",
+    "confirmed": "confirmed",
+    "paid_out": "paid_out",
+    "cancelled": "cancelled",
+    "failed": "failed",
+    "late_failure_settled": "failed",
+    "charged_back": "charged_back",
+    "chargeback_settled": "charged_back",
+    "chargeback_cancelled": "paid_out",
+}
+
+# Order of the statuses a collected payment moves through. A payment never
+# moves back along it, so a late event for an earlier step is ignored; every
+# other status (failed, cancelled, charged back...) always applies.
+PAYMENT_STATUS_RANK = {
+    "pending_customer_approval": 0,
+    "pending_submission": 0,
+    "submitted": 1,
+    "confirmed": 2,
+    "paid_out": 3,
+}
+
+# payments whose action implies no status are looked up in a list of the
+# payments created this many days before their oldest event
+PAYMENT_SCAN_DAYS = 14
+
+
+def is_status_regression(current, status):
+    """True if `status` is an earlier step of the collection than `current`"""
+    current = (current or "").lower().replace(" ", "_")
+    if status not in PAYMENT_STATUS_RANK or current not in PAYMENT_STATUS_RANK:
+        return False
+
+    return PAYMENT_STATUS_RANK[status] < PAYMENT_STATUS_RANK[current]
+
+
+def get_gocardless_payments(payment_ids, since):
+    """Fetch payments with one list scan over everything created since `since`, single gets for the rest"""
+    from isp_billing.api.gocardless_sync import scan_created_since
+
+    client = get_gocardless_client()
+    return scan_created_since(client.payments, since.strftime("%Y-%m-%dT%H:%M:%S.000Z"), set(payment_ids))
+
+
+def apply_gocardless_payment_events(events):
+    """
+    Update the Sales Invoices of a batch of payment events in one bulk write.
+    The status follows from the event action and the invoice from the payment
+    metadata carried by the event (or the payment id stored on the invoice),
+    so the API is only called for actions that say nothing about the status.
+    Events older than one already applied to the same payment, and events that
+    would move a payment back to an earlier step, are ignored.
+    """
+
+    if not events:
+        return
+
+    last_applied = get_last_applied({event.resource_id for event in events})
+
+    # 🔹 Latest state per payment; events come oldest first
+    payments = {}
+    for event in events:
+        applied = last_applied.get(event.resource_id)
+        if applied and event.event_created_at and event.event_created_at < applied:
+            continue
+
+        data = json.loads(event.payload)
+        payments[event.resource_id] = {
+            "status": PAYMENT_ACTION_STATUSES.get(event.action),
+            "invoice": (data.get("resource_metadata") or {}).get("erpnext_invoice"),
+            "created": event.event_created_at
+        }
+
+    # 🔹 Actions that imply no status: read the payments from one list call
+    unknown = {payment_id: payment for payment_id, payment in payments.items() if not payment["status"]}
+    if unknown:
+        since = frappe.utils.add_days(
+            min(payment["created"] or frappe.utils.now_datetime() for payment in unknown.values()),
+            -PAYMENT_SCAN_DAYS
+        )
+        for payment_id, resource in get_gocardless_payments(unknown, since).items():
+            payment = unknown[payment_id]
+            payment["status"] = resource.status
+            payment["invoice"] = payment["invoice"] or (resource.metadata or {}).get("erpnext_invoice")
+
+    # 🔹 Payments created outside this app carry no metadata: match them on the stored payment id
+    unresolved = [payment_id for payment_id, payment in payments.items() if not payment["invoice"]]
+    if unresolved:
+        for row in frappe.get_all(
+            "Sales Invoice",
+            filters={"custom_gocardless_payment_id": ["in", unresolved]},
+            fields=["name", "custom_gocardless_payment_id"]
+        ):
+            payments[row.custom_gocardless_payment_id]["invoice"] = row.name
+
+    invoices = {payment["invoice"] for payment in payments.values() if payment["invoice"]}
+    if not invoices:
+        return
+
+    current = {
+        row.name: row
+        for row in frappe.get_all(
+            "Sales Invoice",
+            filters={"name": ["in", list(invoices)]},
+            fields=[
+                "name",
+                "customer",
+                "outstanding_amount",
+                "custom_gocardless_payment_id",
+                "custom_gocardless_payment_status"
+            ]
+        )
+    }
+
+    updates = {}
+    paid_out = []
+    for payment_id, payment in payments.items():
+        si = current.get(payment["invoice"])
+        if not si:
+            continue
+
+        # 🔹 A late event for an earlier step must not undo a later one
+        if si.custom_gocardless_payment_id == payment_id and is_status_regression(
+            si.custom_gocardless_payment_status, payment["status"]
+        ):
+            continue
+
+        updates[si.name] = {
+            "custom_gocardless_payment_id": payment_id,
+            "custom_gocardless_payment_status": payment["status"]
+        }
+        if payment["status"] == "paid_out" and si.custom_gocardless_payment_status != "paid_out":
+            paid_out.append(si)
+
+    frappe.db.bulk_update("Sales Invoice", updates)
+
+    send_payment_confirmations(paid_out)
+
+
+
+def apply_gocardless_mandate_events(events):
+    """
+    Keep GoCardless Mandates.status current from a batch of mandate events.
+    Known rows are updated in one bulk write; mandates seen for the first time
+    are inserted, which links them to their Customer.
+    """
+
+    # 🔹 Latest status per mandate; events come oldest first
+    mandates = {event.resource_id: MANDATE_ACTION_STATUSES.get(event.action) for event in events}
+
+    customer_ids = {}
+    client = None
+    for mandate_id, status in mandates.items():
+        if status:
+            continue
+
+        client = client or get_gocardless_client()
+        mandate = client.mandates.get(mandate_id)
+        mandates[mandate_id] = mandate.status
+        customer_ids[mandate_id] = mandate.links.customer
+
+    existing = dict(frappe.get_all(
+        "GoCardless Mandates",
+        filters={"mandate_id": ["in", list(mandates)]},
+        fields=["mandate_id", "name"],
+        as_list=True
+    ))
+
+    frappe.db.bulk_update("GoCardless Mandates", {
+        existing[mandate_id]: {"status": status}
+        for mandate_id, status in mandates.items()
+        if mandate_id in existing
+    })
+
+    for mandate_id, status in mandates.items():
+        if mandate_id in existing:
+            continue
+
+        frappe.get_doc({
+            "doctype": "GoCardless Mandates",
+            "mandate_id": mandate_id,
+            "status": status,
+            "customer_id": customer_ids.get(mandate_id)
+        }).insert(ignore_permissions=True)
+
+
+
+def send_payment_confirmations(invoices):
+    """Queue the Payment Confirmation email for invoices whose payment has been paid out"""
+
+    if not invoices:
+        return
+
+    payment_confirmation = frappe.get_doc("Email Template", "Payment Confirmation")
+    emails = dict(frappe.get_all(
+        "Customer",
+        filters={"name": ["in", list({si.customer for si in invoices})]},
+        fields=["name", "custom_email"],
+        as_list=True
+    ))
+
+    for si in invoices:
+        if not emails.get(si.customer):
+            continue
+
+        context = {
+            "customer": si.customer,
+            "amount": si.outstanding_amount,
+            "invoice_number": si.name
+        }
+
+        frappe.sendmail(
+            recipients=emails[si.customer],
+            subject=frappe.render_template(payment_confirmation.subject, context),
+            message=frappe.render_template(payment_confirmation.response, context)
+        )
+
+
+
+def handle_gocardless_event(event):
+    """Apply one GoCardless event to the local documents"""
+
+    event_type = event.get("resource_type")
+
+    if event_type == "customers":
+        customer_id = event.get("links", {}).get("customer")
+
+        # already mirrored, e.g. by sync_gocardless
+        if frappe.db.exists("GoCardless Customer", {"customer_id": customer_id}):
+            return
+
+        client = get_gocardless_client()
+
+        customer = client.customers.get(customer_id)
+
+        frappe.logger().info(f"New Customer Created: {customer}")
+
+        # Save customer in a custom Doctype (example: GoCardless Customer)
+        doc = frappe.get_doc({
+            "doctype": "GoCardless Customer",
+            "customer_id": customer.id,
+            "email": customer.email,
+            "given_name": customer.given_name,
+            "family_name": customer.family_name
+        })
+        doc.insert(ignore_permissions=True)
+
+    elif event_type == "payouts" and event.get("action") == "paid":
+        from isp_billing.api.gocardless_payout import enqueue_payout_reconciliation
+
+        enqueue_payout_reconciliation(event.get("links", {}).get("payout"))
 
-    except Exception as e:
-        frappe.log_error(frappe.get_traceback(), "GoCardless Webhook Error")
-        return "Error"
 
 
 def verify_webhook_signature(payload, signature):
@@ -503,16 +747,9 @@ def verify_webhook_signature(payload, signature):
 def get_customer_from_mandate(mandate_id):
     """Fetch customer_id and email from GoCardless using mandate_id"""
 
-    access_token = get_gocardless_access_token()
-    token = access_token.get("access_token")
-
     try:
 
-        # Initialize client
-        client = gocardless_pro.Client(
-            access_token=token,
-            environment="sandbox"
-        )
+        client = get_gocardless_client()
 
         # Step 1: Get Mandate details
         mandate = client.mandates.get(mandate_id)
@@ -542,31 +779,20 @@ same email then it will add mandate id in the customer document.
  """
 def process_new_mandate(doc, method):
     """
-    Runs when a new GoCardless Mandates doc is added
+    Runs when a new GoCardless Mandates doc is added. Matching it to a
+    Customer needs the GoCardless API, so it is left to a background job that
+    resolves every pending mandate in one go.
     """
-    mandate_id = doc.mandate_id
-    if not mandate_id:
-        return
-
-    # Step 1: Fetch customer details from GoCardless
-    details = get_customer_from_mandate(mandate_id)
-    if not details:
+    if not doc.mandate_id:
         return
 
-    email = details.get("email")
-    if not email:
-        return 
-
-    # Step 2: Find Customer with this email
-    customer = frappe.get_value("Customer", {"custom_email": email}, "name")
-
-    if customer:
-        # Step 3: Update Customer with mandate id
-        frappe.db.set_value("Customer", customer, "custom_gocardless_mandate_id", details.get("mandate_id"))
-        frappe.db.commit()
-
-    if not customer:
-        return "No Customer exists with this email"
+    frappe.enqueue(
+        "isp_billing.api.gocardless_sync.resolve_pending_mandates",
+        queue="short",
+        job_id="isp_billing_resolve_pending_mandates",
+        deduplicate=True,
+        enqueue_after_commit=True
+    )
 
 
 
@@ -582,55 +808,20 @@ this code is used to create invoice for subscription_plan in cli subscription
 @frappe.whitelist()
 def create_invoices_for_subscription(subscription):
 
-    access_token = get_gocardless_access_token()
-    token = access_token.get("access_token")
-
-    sub_doc = frappe.get_doc("CLI Subscription", subscription)
+    # same lock as the billing run, which bills all of a customer's subscriptions together
+    customer = frappe.db.get_value("CLI Subscription", subscription, "customer")
 
-    if not sub_doc.customer:
-        return("Customer is required in CLI Subscription")
-    print(sub_doc.customer)
+    with billing_lock(customer) as locked:
+        if not locked:
+            return {"success": True, "created_invoices": [], "message": f"{subscription} is already being billed"}
 
-    # get customer doc to fetch mandate id
-    customer_doc = frappe.get_doc("Customer", sub_doc.customer)
-    mandate_id = customer_doc.custom_gocardless_mandate_id
-
-    services = sub_doc.get("service") or []  
-
-    created_invoices = []
-
-    for svc in services:
-        if svc.status != "Active":
-            continue
-
-        if svc.sales_invoice_id:
-            continue
+        services = get_billable_services([subscription])
 
-        # Fetch Subscription Plan to get item
-        plan = frappe.get_doc("Subscription Plan", svc.plan)
-        if not plan.item:
-            return(f"No Item linked in Subscription Plan {svc.plan}")
-
-        # Create Sales Invoice for this plan
-        si = frappe.new_doc("Sales Invoice")
-        si.customer = sub_doc.customer
-        si.due_date = frappe.utils.nowdate()
-
-        si.append("items", {
-            "item_code": plan.item,
-            "qty": svc.quantity,
-            "rate": svc.price
-        })
-
-        si.insert(ignore_permissions=True)
-        si.submit()
-        created_invoices.append((si.name, plan.plan_name or plan.name))
-
-        # 🔹 Save Sales Invoice ID in service row
-        svc.sales_invoice_id = si.name
+        # consolidated or one invoice per service, depending on Isp Billing Setting
+        created = invoice_billable_services(services, due_date=frappe.utils.nowdate())
+        frappe.db.commit()
 
-    # 🔹 Save subscription so child table updates
-    sub_doc.save(ignore_permissions=True)
+    created_invoices = [invoice for row in created for invoice in row["invoices"]]
 
     return {"success": True, "created_invoices": created_invoices}
 
@@ -645,9 +836,32 @@ Bulk generation of sales invoice for CLI Subscription Documents
 
 @frappe.whitelist()
 def generate_invoices(subscription):
+    """
+    Generate invoices for one or more CLI Subscriptions picked in the list view.
+    The work is recorded as a manual Billing Run, so repeating an interrupted
+    call resumes after the last customer it committed.
+    """
+    if isinstance(subscription, str) and subscription.startswith("["):
+        subscription = frappe.parse_json(subscription)
+    subscriptions = subscription if isinstance(subscription, list) else [subscription]
+
     try:
-        result = create_invoices_for_subscription(subscription)
-        return result
+        billing_run = get_billing_run("Manual", subscriptions=sorted(subscriptions))
+        created = run_billing_shard(billing_run.name, subscriptions=subscriptions)
+
+        errors = frappe.get_all(
+            "Billing Run Error",
+            filters={"parent": billing_run.name, "parenttype": "Billing Run"},
+            fields=["customer", "error"]
+        )
+
+        return {
+            "success": not errors,
+            "created": created,
+            "billing_run": billing_run.name,
+            "errors": errors,
+            "error": "\n".join(f"{row.customer}: {row.error}" for row in errors)
+        }
     except Exception as e:
         frappe.log_error(title="Invoice Generation Failed", message=frappe.get_traceback())
         return {"success": False, "error": str(e)}
@@ -676,13 +890,7 @@ def create_one_off_payment(doc, method=None):
     if not mandate_id:
         frappe.throw(f"No GoCardless Mandate ID found for customer {si.customer}")
 
-    access_token = get_gocardless_access_token()
-    token = access_token.get("access_token")
-
-    client = gocardless_pro.Client(
-        access_token=token,
-        environment="sandbox"
-    )
+    client = get_gocardless_client()
 
     try:
         payment = client.payments.create(params={
@@ -698,6 +906,12 @@ def create_one_off_payment(doc, method=None):
         })
 
         frappe.msgprint(f"GoCardless One-Off Payment created: {payment.id}")
+        # keep the payment id on the invoice so webhook events can be matched to it locally
+        si.db_set({
+            "custom_gocardless_payment_id": payment.id,
+            "custom_gocardless_payment_status": payment.status
+        })
+
         return {"success": True, "payment_id": payment.id}
 
     except Exception as e:
@@ -717,35 +931,23 @@ from frappe import _
 def create_one_sales_invoice_payment(invoice_name):
     """Create a one-off payment in GoCardless for a given Sales Invoice"""
 
-    si = frappe.get_doc("Sales Invoice", invoice_name)
-
-    if not si.customer:
-        frappe.throw(_("Customer is required in Sales Invoice"))
-
-    customer_doc = frappe.get_doc("Customer", si.customer)
-    mandate_id = customer_doc.custom_gocardless_mandate_id
-    if not mandate_id:
-        frappe.throw(_(f"No GoCardless Mandate ID found for customer {si.customer}"))
+    instructions, rejected = get_charge_instructions([invoice_name], "GoCardless")
+    if rejected:
+        frappe.throw(_(rejected[0]["error"]))
 
-    access_token = get_gocardless_access_token()
-    token = access_token.get("access_token")
-
-    client = gocardless_pro.Client(
-        access_token=token,
-        environment="sandbox"
-    )
+    instruction = instructions[0]
+    client = get_gocardless_client()
 
     try:
-        payment = client.payments.create(params={
-            "amount": int(si.grand_total * 100),
-            "currency": si.currency or "GBP",
-            "links": {
-                "mandate": mandate_id
-            },
-            "metadata": {
-                "erpnext_invoice": si.name,
-                "customer": si.customer
-            }
+        payment = client.payments.create(
+            params=get_payment_params(instruction),
+            headers={"Idempotency-Key": get_payment_idempotency_key(instruction)}
+        )
+
+        # keep the payment id on the invoice so webhook events can be matched to it locally
+        frappe.db.set_value("Sales Invoice", instruction.invoice, {
+            "custom_gocardless_payment_id": payment.id,
+            "custom_gocardless_payment_status": payment.status
         })
 
         return {"success": True, "payment_id": payment.id}
@@ -771,33 +973,160 @@ import frappe
 @frappe.whitelist()
 def bulk_create_gocardless_payments(invoices):
     """
-    Create GoCardless one-off payments for multiple Sales Invoices.
+    Create GoCardless one-off payments for multiple Sales Invoices in a
+    background job. Progress and the final results are published to the
+    calling user as "gocardless_payment_progress" realtime events.
     invoices: list of Sales Invoice names
     """
     if isinstance(invoices, str):
         invoices = frappe.parse_json(invoices)
 
-    results = []
+    job_id = f"isp_billing_gocardless_payments::{frappe.generate_hash(length=10)}"
+
+    frappe.enqueue(
+        "isp_billing.api.gocardless.create_gocardless_payments",
+        queue="long",
+        timeout=2 * 60 * 60,
+        job_id=job_id,
+        invoices=invoices,
+        user=frappe.session.user,
+        progress_id=job_id
+    )
+
+    return {"success": True, "job_id": job_id, "queued": len(invoices)}
+
+
+
+"""
+Bulk payment creation: the payments.create calls are sent from a bounded
+thread pool over the shared pooled client. Threads only talk to GoCardless;
+reading the invoices and writing the results back stays on the job's own
+database connection.
+"""
+
+# parallel payments.create calls per job
+GOCARDLESS_PAYMENT_WORKERS = 8
 
-    for inv in invoices:
+# pause once fewer requests than this are left in the current rate limit window
+GOCARDLESS_RATE_LIMIT_RESERVE = 2 * GOCARDLESS_PAYMENT_WORKERS
+
+# publish progress after this many payments
+GOCARDLESS_PROGRESS_EVERY = 25
+
+
+class RateLimitThrottle:
+    """Holds back new requests when the RateLimit-Remaining header runs low, until the window resets"""
+
+    def __init__(self, rate_limit, reserve=GOCARDLESS_RATE_LIMIT_RESERVE):
+        self.rate_limit = rate_limit
+        self.reserve = reserve
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            remaining = self.rate_limit.remaining
+            if remaining is None or remaining > self.reserve:
+                return
+
+            time.sleep(self.get_seconds_to_reset())
+            # the next response reports the new window
+            self.rate_limit.remaining = None
+
+    def get_seconds_to_reset(self):
         try:
-            res = create_one_sales_invoice_payment(inv)
-            results.append({
-                "invoice": inv,
-                "success": True,
-                "payment_id": res.get("payment_id")
-            })
-        except Exception as e:
-            frappe.log_error(frappe.get_traceback(), "GoCardless Bulk Payment Error")
-            results.append({
-                "invoice": inv,
-                "success": False,
-                "error": str(e)
-            })
+            reset = parsedate_to_datetime(self.rate_limit.reset)
+        except (TypeError, ValueError):
+            return 60
+
+        return min(max((reset - datetime.now(timezone.utc)).total_seconds(), 1), 60)
+
+
+def get_payment_params(instruction):
+    return {
+        "amount": instruction.amount_minor,
+        "currency": instruction.currency or "GBP",
+        "links": {
+            "mandate": instruction.mandate_id
+        },
+        "metadata": {
+            "erpnext_invoice": instruction.invoice,
+            "customer": instruction.customer
+        }
+    }
+
+
+def create_gocardless_payments(invoices, user=None, progress_id=None):
+    """Background job behind bulk_create_gocardless_payments"""
+
+    # 🔹 One query for every invoice; ineligible ones never reach the API
+    payable, results = get_charge_instructions(invoices, "GoCardless")
+    for res in results:
+        res["success"] = False
+
+    client = get_gocardless_client()
+    throttle = RateLimitThrottle(client._api_client.rate_limit)
+
+    def create_payment(instruction):
+        throttle.wait()
+        try:
+            return client.payments.create(
+                params=get_payment_params(instruction),
+                headers={"Idempotency-Key": get_payment_idempotency_key(instruction)}
+            )
+        except gocardless_pro.errors.RateLimitError:
+            # the window ran out under us: wait for the reset and try once more
+            time.sleep(throttle.get_seconds_to_reset())
+            return client.payments.create(
+                params=get_payment_params(instruction),
+                headers={"Idempotency-Key": get_payment_idempotency_key(instruction)}
+            )
+
+    updates = {}
+
+    with ThreadPoolExecutor(max_workers=GOCARDLESS_PAYMENT_WORKERS) as executor:
+        futures = {executor.submit(create_payment, instruction): instruction for instruction in payable}
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            instruction = futures[future]
+            try:
+                payment = future.result()
+            except Exception as e:
+                frappe.log_error(f"{instruction.invoice}: {e}", "GoCardless Bulk Payment Error")
+                results.append({"invoice": instruction.invoice, "success": False, "error": str(e)})
+            else:
+                updates[instruction.invoice] = {
+                    "custom_gocardless_payment_id": payment.id,
+                    "custom_gocardless_payment_status": payment.status
+                }
+                results.append({"invoice": instruction.invoice, "success": True, "payment_id": payment.id})
+
+            if done % GOCARDLESS_PROGRESS_EVERY == 0:
+                publish_payment_progress(progress_id, user, done, len(payable), results)
+
+    # 🔹 Store every payment id on its invoice in one write
+    frappe.db.bulk_update("Sales Invoice", updates)
+    frappe.db.commit()
+
+    publish_payment_progress(progress_id, user, len(payable), len(payable), results, finished=True)
 
     return results
 
 
+def publish_payment_progress(progress_id, user, done, total, results, finished=False):
+    message = {
+        "job_id": progress_id,
+        "done": done,
+        "total": total,
+        "succeeded": sum(1 for res in results if res["success"]),
+        "failed": sum(1 for res in results if not res["success"]),
+        "finished": finished
+    }
+    if finished:
+        message["results"] = results
+
+    frappe.publish_realtime("gocardless_payment_progress", message, user=user, after_commit=False)
+
+
 
 
 
@@ -813,15 +1142,9 @@ def bulk_create_gocardless_payments(invoices):
 def get_gocardless_payment_details(payment_id: str):
     """Fetch full payment details (with metadata, links, org details etc.) from GoCardless"""
 
-    access_token = get_gocardless_access_token()
-    token = access_token.get("access_token")
-
     try:
 
-        client = gocardless_pro.Client(
-            access_token=token,
-            environment="sandbox"  # 🔹 change to 'live' in production
-        )
+        client = get_gocardless_client()
 
         payment = client.payments.get(payment_id)
 
@@ -0,0 +1,206 @@
+"""
+Payout reconciliation: when GoCardless pays a payout out, its payout items
+are matched to Sales Invoices by custom_gocardless_payment_id in one query
+and booked as one Payment Entry per customer, referenced to the payout id.
+Invoices already reconciled against the payout are skipped, so the job can
+be rerun or resumed safely.
+"""
+
+import frappe
+from frappe import _
+from frappe.query_builder import DocType
+from frappe.utils import flt
+
+from isp_billing.api.gocardless import get_gocardless_client
+
+PAGE_SIZE = 500
+
+# payout item types that carry the fee GoCardless kept from a payment
+FEE_ITEM_TYPES = ("gocardless_fee", "app_fee", "surcharge_fee")
+
+
+def enqueue_payout_reconciliation(payout_id):
+	frappe.enqueue(
+		"isp_billing.api.gocardless_payout.reconcile_gocardless_payout",
+		queue="long",
+		timeout=2 * 60 * 60,
+		job_id=f"isp_billing_gocardless_payout::{payout_id}",
+		deduplicate=True,
+		enqueue_after_commit=True,
+		payout_id=payout_id,
+	)
+
+
+@frappe.whitelist()
+def reconcile_payout(payout_id):
+	"""Reconcile a payout from the desk, in the background"""
+	enqueue_payout_reconciliation(payout_id)
+	return {"success": True, "payout": payout_id}
+
+
+def get_payout_items(client, payout_id):
+	"""Gross amount and fees per GoCardless payment in a payout, in major units"""
+
+	payments = {}
+	params = {"payout": payout_id, "limit": PAGE_SIZE}
+
+	while True:
+		page = client.payout_items.list(params=params)
+
+		for item in page.records:
+			payment_id = (item.attributes.get("links") or {}).get("payment")
+			if not payment_id:
+				continue
+
+			# amounts are strings in minor units, fees are negative
+			amount = flt(item.amount) / 100
+			row = payments.setdefault(payment_id, {"gross": 0.0, "fees": 0.0})
+			if item.type == "payment_paid_out":
+				row["gross"] += amount
+			elif item.type in FEE_ITEM_TYPES:
+				row["fees"] -= amount
+
+		if not page.after:
+			break
+		params["after"] = page.after
+
+	return payments
+
+
+def get_reconciled_invoices(payout_id):
+	"""Invoices already settled by a submitted Payment Entry for this payout"""
+
+	PaymentEntry = DocType("Payment Entry")
+	Reference = DocType("Payment Entry Reference")
+
+	return set(
+		(
+			frappe.qb.from_(Reference)
+			.join(PaymentEntry)
+			.on(PaymentEntry.name == Reference.parent)
+			.select(Reference.reference_name)
+			.where(PaymentEntry.reference_no == payout_id)
+			.where(PaymentEntry.docstatus == 1)
+			.where(Reference.reference_doctype == "Sales Invoice")
+		).run(pluck=True)
+	)
+
+
+def reconcile_gocardless_payout(payout_id):
+	"""Background job: book every payment of a paid-out GoCardless payout against its Sales Invoice"""
+
+	settings = frappe.get_cached_doc("Isp Billing Setting")
+	if not settings.gocardless_clearing_account:
+		frappe.log_error(
+			f"Set the GoCardless Clearing Account in Isp Billing Setting to reconcile payout {payout_id}",
+			"GoCardless Payout Reconciliation",
+		)
+		return
+
+	client = get_gocardless_client()
+	payout = client.payouts.get(payout_id)
+	payments = get_payout_items(client, payout_id)
+	if not payments:
+		return
+
+	# 🔹 Match every payment of the payout to its invoice in one query
+	SalesInvoice = DocType("Sales Invoice")
+	invoices = (
+		frappe.qb.from_(SalesInvoice)
+		.select(
+			SalesInvoice.name,
+			SalesInvoice.customer,
+			SalesInvoice.company,
+			SalesInvoice.debit_to,
+			SalesInvoice.outstanding_amount,
+			SalesInvoice.custom_gocardless_payment_id,
+		)
+		.where(SalesInvoice.custom_gocardless_payment_id.isin(list(payments)))
+		.where(SalesInvoice.docstatus == 1)
+	).run(as_dict=True)
+
+	reconciled = get_reconciled_invoices(payout_id)
+
+	entries = {}
+	for si in invoices:
+		if si.name in reconciled or flt(si.outstanding_amount) <= 0:
+			continue
+		entries.setdefault((si.customer, si.company, si.debit_to), []).append(si)
+
+	created = []
+	for (customer, company, debit_to), rows in entries.items():
+		try:
+			pe = make_payout_payment_entry(payout, customer, company, debit_to, rows, payments, settings)
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(
+				frappe.get_traceback(), f"GoCardless payout {payout_id}: Payment Entry for {customer} failed"
+			)
+			continue
+
+		created.append(pe.name)
+		frappe.db.commit()
+
+	unmatched = set(payments) - {si.custom_gocardless_payment_id for si in invoices}
+	if unmatched:
+		frappe.log_error(
+			"\n".join(sorted(unmatched)),
+			f"GoCardless payout {payout_id}: {len(unmatched)} payments without a Sales Invoice",
+		)
+
+	return {"success": True, "payout": payout_id, "payment_entries": created, "unmatched": len(unmatched)}
+
+
+def make_payout_payment_entry(payout, customer, company, debit_to, invoices, payments, settings):
+	"""One submitted Payment Entry for all invoices of a customer in a payout"""
+
+	references = []
+	fees = 0.0
+	for si in invoices:
+		payment = payments[si.custom_gocardless_payment_id]
+		references.append(
+			{
+				"reference_doctype": "Sales Invoice",
+				"reference_name": si.name,
+				"allocated_amount": min(payment["gross"], flt(si.outstanding_amount)),
+			}
+		)
+		fees += payment["fees"]
+
+	allocated = sum(ref["allocated_amount"] for ref in references)
+
+	deductions = []
+	if settings.gocardless_fees_account and fees:
+		deductions.append(
+			{
+				"account": settings.gocardless_fees_account,
+				"cost_center": frappe.get_cached_value("Company", company, "cost_center"),
+				"amount": fees,
+			}
+		)
+	else:
+		fees = 0.0
+
+	pe = frappe.get_doc(
+		{
+			"doctype": "Payment Entry",
+			"payment_type": "Receive",
+			"company": company,
+			"posting_date": payout.arrival_date,
+			"party_type": "Customer",
+			"party": customer,
+			"paid_from": debit_to,
+			"paid_to": settings.gocardless_clearing_account,
+			"paid_amount": allocated - fees,
+			"received_amount": allocated - fees,
+			"reference_no": payout.id,
+			"reference_date": payout.arrival_date,
+			"remarks": _("GoCardless payout {0}").format(payout.reference or payout.id),
+			"references": references,
+			"deductions": deductions,
+		}
+	)
+	pe.insert(ignore_permissions=True)
+	pe.submit()
+
+	return pe
@@ -0,0 +1,369 @@
+"""
+Incremental GoCardless sync: pages through customers, mandates, payments and
+events created since the last run (created_at[gte] the stored cursor) and
+upserts them locally page by page. Payments are mirrored onto the Sales
+Invoice they collect, which also picks up payments whose create call timed
+out. Replaying events through the webhook event store repairs payment and
+mandate status changes whose webhook was missed. GoCardless subscriptions
+have no local record to sync into: billing runs from CLI Subscription, and
+the payments they raise arrive through the payments and events lists.
+"""
+
+import frappe
+from frappe.utils import add_days, now_datetime
+
+from isp_billing.api.customer import get_email_key
+from isp_billing.api.gocardless import enqueue_gocardless_event_processing, get_gocardless_client
+from isp_billing.isp_billing.doctype.billing_sync_cursor.billing_sync_cursor import (
+	get_sync_cursor,
+	set_sync_cursor,
+)
+from isp_billing.isp_billing.doctype.gocardless_mandates.gocardless_mandates import DEAD_MANDATE_STATUSES
+from isp_billing.isp_billing.doctype.gocardless_webhook_event.gocardless_webhook_event import (
+	insert_webhook_events,
+)
+
+PAGE_SIZE = 500
+
+# the first payments and events sync only covers this many days, not the account's whole history
+INITIAL_EVENT_DAYS = 7
+
+
+def list_created_since(service, cursor):
+	"""Yield pages of a GoCardless list endpoint with records created at or after cursor"""
+
+	params = {"limit": PAGE_SIZE}
+	if cursor:
+		params["created_at[gte]"] = cursor
+
+	while True:
+		page = service.list(params=params)
+		if page.records:
+			yield page.records
+
+		if not page.after:
+			break
+		params["after"] = page.after
+
+
+def sync_resource(resource, service, upsert, initial_cursor=None):
+	"""
+	Sync one resource from its cursor. The cursor is only moved once every page
+	has been written; an interrupted sync starts over from the old cursor and
+	the upserts make the overlap harmless.
+	"""
+
+	cursor = get_sync_cursor("GoCardless", resource) or initial_cursor
+	newest = cursor
+	count = 0
+
+	for records in list_created_since(service, cursor):
+		upsert(records)
+		frappe.db.commit()
+
+		count += len(records)
+		newest = max([newest or ""] + [record.created_at for record in records])
+
+	set_sync_cursor("GoCardless", resource, newest, count)
+	frappe.db.commit()
+
+	return count
+
+
+def upsert_records(doctype, id_field, rows):
+	"""Insert or update mirror rows keyed on their GoCardless id, two statements per page"""
+
+	existing = dict(
+		frappe.get_all(
+			doctype, filters={id_field: ["in", list(rows)]}, fields=[id_field, "name"], as_list=True
+		)
+	)
+
+	frappe.db.bulk_update(
+		doctype, {existing[gc_id]: values for gc_id, values in rows.items() if gc_id in existing}
+	)
+
+	new_rows = [(gc_id, values) for gc_id, values in rows.items() if gc_id not in existing]
+	if not new_rows:
+		return []
+
+	now = now_datetime()
+	fields = list(new_rows[0][1])
+	frappe.db.bulk_insert(
+		doctype,
+		["name", id_field, *fields, "creation", "modified", "owner", "modified_by"],
+		[
+			(
+				frappe.generate_hash(length=10),
+				gc_id,
+				*[values[f] for f in fields],
+				now,
+				now,
+				"Administrator",
+				"Administrator",
+			)
+			for gc_id, values in new_rows
+		],
+		# a webhook may have inserted the same record since the lookup above
+		ignore_duplicates=True,
+	)
+
+	return [gc_id for gc_id, _ in new_rows]
+
+
+def upsert_customers(records):
+	upsert_records(
+		"GoCardless Customer",
+		"customer_id",
+		{
+			record.id: {
+				"email": record.email,
+				"given_name": record.given_name,
+				"family_name": record.family_name,
+				"created_at": record.created_at,
+			}
+			for record in records
+		},
+	)
+
+
+def upsert_mandates(records):
+	rows = {
+		record.id: {
+			"status": record.status,
+			"customer_id": record.links.customer,
+			"scheme": record.scheme,
+			"created_at": record.created_at,
+		}
+		for record in records
+	}
+
+	new_mandates = upsert_records("GoCardless Mandates", "mandate_id", rows)
+	link_mandates_to_customers({mandate_id: rows[mandate_id] for mandate_id in new_mandates})
+
+
+def upsert_payments(records):
+	"""
+	Store the id and status of each payment on the Sales Invoice named in its
+	metadata, unless the invoice already carries a different payment
+	"""
+
+	payments = {
+		(record.metadata or {}).get("erpnext_invoice"): record
+		for record in records
+		if (record.metadata or {}).get("erpnext_invoice")
+	}
+	if not payments:
+		return
+
+	current = dict(
+		frappe.get_all(
+			"Sales Invoice",
+			filters={"name": ["in", list(payments)], "docstatus": 1},
+			fields=["name", "custom_gocardless_payment_id"],
+			as_list=True,
+		)
+	)
+
+	frappe.db.bulk_update(
+		"Sales Invoice",
+		{
+			invoice: {
+				"custom_gocardless_payment_id": record.id,
+				"custom_gocardless_payment_status": record.status,
+			}
+			for invoice, record in payments.items()
+			if invoice in current and current[invoice] in (None, "", record.id)
+		},
+	)
+
+
+def upsert_events(records):
+	insert_webhook_events([record.attributes for record in records])
+
+
+def link_mandates_to_customers(mandates):
+	"""
+	Set custom_gocardless_mandate_id on the Customers of new mandates and link
+	the mandates back to them, matching the GoCardless customer's email from
+	the local mirror against the normalised Customer email key instead of
+	asking the API.
+	"""
+
+	live = {
+		mandate_id: row["customer_id"]
+		for mandate_id, row in mandates.items()
+		if row["customer_id"] and row["status"] not in DEAD_MANDATE_STATUSES
+	}
+	if not live:
+		return
+
+	emails = {
+		customer_id: get_email_key(email)
+		for customer_id, email in frappe.get_all(
+			"GoCardless Customer",
+			filters={"customer_id": ["in", list(set(live.values()))]},
+			fields=["customer_id", "email"],
+			as_list=True,
+		)
+	}
+
+	customers = dict(
+		frappe.get_all(
+			"Customer",
+			filters={"custom_email_key": ["in", [email for email in emails.values() if email]]},
+			fields=["custom_email_key", "name"],
+			as_list=True,
+		)
+	)
+
+	mandate_names = dict(
+		frappe.get_all(
+			"GoCardless Mandates",
+			filters={"mandate_id": ["in", list(live)]},
+			fields=["mandate_id", "name"],
+			as_list=True,
+		)
+	)
+
+	updates = {}
+	links = {}
+	for mandate_id, customer_id in live.items():
+		customer = customers.get(emails.get(customer_id))
+		if customer:
+			updates[customer] = {"custom_gocardless_mandate_id": mandate_id}
+			links[mandate_names[mandate_id]] = {"customer": customer}
+
+	# 🔹 One write per doctype for the whole batch
+	frappe.db.bulk_update("Customer", updates)
+	frappe.db.bulk_update("GoCardless Mandates", links)
+
+
+"""
+Pending mandate resolver: mandates inserted by webhooks or by hand are
+linked to their Customer here instead of in the insert transaction. Missing
+GoCardless customer ids and emails are filled from list calls over the
+window the mandates were created in; only records the lists do not reach
+are fetched one by one.
+"""
+
+# mandates resolved per run
+RESOLVE_BATCH_SIZE = 1000
+
+# pages a list scan may read before falling back to single gets
+MAX_SCAN_PAGES = 10
+
+
+def scan_created_since(service, since, wanted):
+	"""Collect the records with ids in `wanted` from a list of everything created since `since`"""
+
+	found = {}
+	for pages, records in enumerate(list_created_since(service, since), start=1):
+		found.update({record.id: record for record in records if record.id in wanted})
+		if len(found) == len(wanted) or pages >= MAX_SCAN_PAGES:
+			break
+
+	for record_id in wanted - set(found):
+		found[record_id] = service.get(record_id)
+
+	return found
+
+
+def get_scan_start(rows, days):
+	"""GoCardless created_at a little before the oldest local row, to absorb clock and timezone skew"""
+	oldest = min(row.creation for row in rows)
+	return add_days(oldest, -days).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def resolve_pending_mandates():
+	"""Background job: link every unlinked, live GoCardless mandate to its Customer"""
+
+	pending = frappe.get_all(
+		"GoCardless Mandates",
+		filters={
+			"customer": ["is", "not set"],
+			"mandate_id": ["is", "set"],
+			"status": ["not in", DEAD_MANDATE_STATUSES],
+		},
+		fields=["name", "mandate_id", "customer_id", "status", "creation"],
+		order_by="creation desc",
+		limit=RESOLVE_BATCH_SIZE,
+	)
+	if not pending:
+		return
+
+	client = get_gocardless_client()
+
+	# 🔹 1. GoCardless customer id of each mandate, from one mandates list scan
+	unknown = [row for row in pending if not row.customer_id]
+	if unknown:
+		found = scan_created_since(
+			client.mandates, get_scan_start(unknown, 1), {row.mandate_id for row in unknown}
+		)
+
+		frappe.db.bulk_update(
+			"GoCardless Mandates",
+			{
+				row.name: {
+					"customer_id": found[row.mandate_id].links.customer,
+					"status": found[row.mandate_id].status,
+				}
+				for row in unknown
+			},
+		)
+		for row in unknown:
+			row.customer_id = found[row.mandate_id].links.customer
+			row.status = found[row.mandate_id].status
+
+	# 🔹 2. Customers missing from the local mirror, from one customers list scan
+	customer_ids = {row.customer_id for row in pending if row.customer_id}
+	mirrored = set(
+		frappe.get_all(
+			"GoCardless Customer", filters={"customer_id": ["in", list(customer_ids)]}, pluck="customer_id"
+		)
+	)
+	missing = customer_ids - mirrored
+	if missing:
+		# customers are usually created shortly before their mandate
+		found = scan_created_since(client.customers, get_scan_start(pending, 7), missing)
+		upsert_customers(list(found.values()))
+
+	# 🔹 3. Match on the normalised email and write everything in one pass
+	link_mandates_to_customers(
+		{row.mandate_id: {"customer_id": row.customer_id, "status": row.status} for row in pending}
+	)
+	frappe.db.commit()
+
+
+def sync_gocardless():
+	"""Scheduled job: bring the local GoCardless mirror up to date with everything created since the last run"""
+
+	client = get_gocardless_client()
+
+	first_event = add_days(now_datetime(), -INITIAL_EVENT_DAYS).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+	result = {}
+	# customers first, so new mandates can be linked through their customer's email
+	for resource, service, upsert, initial_cursor in (
+		("customers", client.customers, upsert_customers, None),
+		("mandates", client.mandates, upsert_mandates, None),
+		("payments", client.payments, upsert_payments, first_event),
+		("events", client.events, upsert_events, first_event),
+	):
+		try:
+			result[resource] = sync_resource(resource, service, upsert, initial_cursor)
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(frappe.get_traceback(), f"GoCardless {resource} sync failed")
+
+	# mandates are bulk inserted without after_insert, so link the ones the sync could not match here
+	try:
+		resolve_pending_mandates()
+	except Exception:
+		frappe.db.rollback()
+		frappe.log_error(frappe.get_traceback(), "GoCardless pending mandates failed")
+
+	if result.get("events"):
+		enqueue_gocardless_event_processing()
+
+	return result
@@ -0,0 +1,163 @@
+"""
+Pre-flight for direct-debit charging: resolves everything the gateway layer
+needs for a set of Sales Invoices in one joined query and rejects the ones
+that must not be charged, before any API call is made.
+"""
+
+import frappe
+from frappe.query_builder import DocType
+from frappe.utils import cint, flt
+
+from isp_billing.isp_billing.doctype.gocardless_mandates.gocardless_mandates import (
+	DEAD_MANDATE_STATUSES,
+	SUSPENDED_MANDATE_STATUSES,
+)
+
+# gateway payment statuses after which the invoice may be charged again
+GOCARDLESS_RETRYABLE_STATUSES = ("failed", "cancelled", "customer_approval_denied", "charged_back")
+STRIPE_RETRYABLE_STATUSES = ("requires_payment_method", "canceled")
+
+
+def get_charge_instructions(invoices, gateway):
+	"""
+	Return (instructions, rejected) for charging `invoices` through `gateway`
+	("GoCardless" or "Stripe"). Instructions are compact dicts with the amount
+	in minor units and the ids the gateway call needs, in the order the
+	invoices were given; rejected holds {"invoice", "error"} for the rest.
+	"""
+
+	SalesInvoice = DocType("Sales Invoice")
+	Customer = DocType("Customer")
+	Mandate = DocType("GoCardless Mandates")
+
+	rows = (
+		frappe.qb.from_(SalesInvoice)
+		.join(Customer)
+		.on(Customer.name == SalesInvoice.customer)
+		.left_join(Mandate)
+		.on(Mandate.mandate_id == Customer.custom_gocardless_mandate_id)
+		.select(
+			SalesInvoice.name,
+			SalesInvoice.docstatus,
+			SalesInvoice.customer,
+			SalesInvoice.outstanding_amount,
+			SalesInvoice.currency,
+			SalesInvoice.custom_gocardless_payment_id,
+			SalesInvoice.custom_gocardless_payment_status,
+			SalesInvoice.custom_stripe_payment_id,
+			SalesInvoice.custom_stripe_payment_status,
+			Customer.custom_email.as_("email"),
+			Customer.custom_gocardless_mandate_id.as_("mandate_id"),
+			Mandate.status.as_("mandate_status"),
+			Customer.custom_stripe_customer_id.as_("stripe_customer_id"),
+			Customer.custom_stripe_payment_method_id.as_("stripe_payment_method"),
+		)
+		.where(SalesInvoice.name.isin(list(invoices)))
+	).run(as_dict=True)
+
+	found = {row.name: row for row in rows}
+
+	instructions = []
+	rejected = []
+
+	for invoice in invoices:
+		row = found.get(invoice)
+		error = get_rejection(row, gateway) if row else "Sales Invoice not found"
+
+		if error:
+			rejected.append({"invoice": invoice, "error": error})
+			continue
+
+		instructions.append(
+			frappe._dict(
+				{
+					"invoice": row.name,
+					"customer": row.customer,
+					"email": row.email,
+					"amount": flt(row.outstanding_amount),
+					"amount_minor": cint(round(flt(row.outstanding_amount) * 100)),
+					"currency": row.currency,
+					"mandate_id": row.mandate_id,
+					# a failed earlier attempt, so a retry gets a fresh idempotency key
+					"previous_payment_id": row.custom_gocardless_payment_id
+					if gateway == "GoCardless"
+					else row.custom_stripe_payment_id,
+					"stripe_customer_id": row.stripe_customer_id,
+					"stripe_payment_method": row.stripe_payment_method,
+				}
+			)
+		)
+
+	return instructions, rejected
+
+
+def get_payment_idempotency_key(instruction):
+	"""
+	One gateway payment per invoice and attempt: retrying with the same key
+	returns the payment created the first time instead of charging the
+	customer again, while a new attempt after a failed payment gets a new key.
+	"""
+	return f"isp-billing-{instruction.invoice}-{instruction.previous_payment_id or 'first'}"
+
+
+def get_rejection(row, gateway):
+	"""Why an invoice must not be charged through gateway, or None if it can be"""
+
+	if row.docstatus != 1:
+		return "Sales Invoice is not submitted"
+
+	if flt(row.outstanding_amount) <= 0:
+		return "Sales Invoice is already paid"
+
+	# 🔹 A live payment on either gateway means the invoice is already being collected
+	if has_live_gocardless_payment(row):
+		return (
+			f"GoCardless payment {row.custom_gocardless_payment_id} is {row.custom_gocardless_payment_status}"
+		)
+
+	if has_live_stripe_payment(row):
+		return f"Stripe payment {row.custom_stripe_payment_id} is {row.custom_stripe_payment_status}"
+
+	if gateway == "GoCardless" and not row.mandate_id:
+		return f"No GoCardless Mandate ID found for customer {row.customer}"
+
+	# 🔹 Known-dead mandates are skipped locally instead of failing at GoCardless
+	if gateway == "GoCardless" and row.mandate_status in DEAD_MANDATE_STATUSES:
+		return f"GoCardless mandate {row.mandate_id} is {row.mandate_status}"
+
+	if gateway == "GoCardless" and row.mandate_status in SUSPENDED_MANDATE_STATUSES:
+		return f"GoCardless mandate {row.mandate_id} is suspended by the payer, retry once it is reinstated"
+
+	if gateway == "Stripe" and not (row.stripe_customer_id and row.stripe_payment_method):
+		return f"Stripe Customer ID or Payment Method ID is missing for customer {row.customer}"
+
+	return None
+
+
+def has_live_gocardless_payment(row):
+	return bool(row.custom_gocardless_payment_id) and (
+		row.custom_gocardless_payment_status not in GOCARDLESS_RETRYABLE_STATUSES
+	)
+
+
+def has_live_stripe_payment(row):
+	return bool(row.custom_stripe_payment_id) and (
+		row.custom_stripe_payment_status not in STRIPE_RETRYABLE_STATUSES
+	)
+
+
+@frappe.whitelist()
+def preflight_charges(invoices, gateway):
+	"""Check which of the selected invoices can be charged through gateway, without charging anything"""
+
+	if isinstance(invoices, str):
+		invoices = frappe.parse_json(invoices)
+
+	instructions, rejected = get_charge_instructions(invoices, gateway)
+
+	return {
+		"success": True,
+		"eligible": [instruction.invoice for instruction in instructions],
+		"total": sum(instruction.amount for instruction in instructions),
+		"rejected": rejected,
+	}
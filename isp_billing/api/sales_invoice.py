@@ -1,6 +1,31 @@
+from contextlib import contextmanager
+from itertools import groupby
+
 import frappe
-from frappe.query_builder import DocType
-from frappe.utils import add_days, nowdate
+from frappe.query_builder import CustomFunction, DocType
+from frappe.query_builder.functions import IfNull, Lower, Replace
+from frappe.utils import add_days, cint, create_batch, flt, nowdate
+from redis.exceptions import LockError
+
+from isp_billing.isp_billing.doctype.billing_run.billing_run import (
+    finish_shard,
+    get_billing_run,
+    record_checkpoint,
+    record_error,
+    start_shard,
+)
+from isp_billing.isp_billing.doctype.subscription_billing_period.subscription_billing_period import (
+    get_billed_periods,
+)
+from isp_billing.isp_billing.doctype.subscription_service.subscription_service import (
+    get_billing_period_end,
+    get_billing_period_start,
+    get_next_billing_date,
+    skip_billed_periods,
+)
+
+# CRC32 of the customer gives the same shard in every worker and every run
+Crc32 = CustomFunction("CRC32", ["value"])
 
 
 
@@ -41,138 +66,412 @@ def cli_subscription_list():
 
 
 
-@frappe.whitelist()
+def get_billable_services(subscriptions=None, shard=None, shard_count=None, after_customer=None, billing_date=None):
+    """
+    Return every Active service row that is due on or before billing_date (today
+    by default) and has no Subscription Billing Period entry for that date yet,
+    together with the customer and plan item needed to bill it, in a single
+    joined query, ordered by customer. Rows whose Subscription Plan has no Item
+    are left out.
 
-def create_invoices_for_all_subscriptions():
-    """Create invoices for all CLI Subscriptions"""
+    When shard_count is given only the customers hashed into `shard` are returned,
+    and after_customer skips everything up to a Billing Run checkpoint.
+    """
+    Subscription = DocType("CLI Subscription")
+    Service = DocType("Subscription Service")
+    Plan = DocType("Subscription Plan")
+    Customer = DocType("Customer")
+    Ledger = DocType("Subscription Billing Period")
+    Mandate = DocType("GoCardless Mandates")
+
+    query = (
+        frappe.qb.from_(Subscription)
+            .join(Service)
+            .on((Service.parent == Subscription.name) & (Service.parenttype == "CLI Subscription"))
+            .join(Plan)
+            .on(Plan.name == Service.plan)
+            .join(Customer)
+            .on(Customer.name == Subscription.customer)
+            .left_join(Ledger)
+            .on((Ledger.service == Service.name) & (Ledger.billing_date == Service.next_billing_date))
+            .left_join(Mandate)
+            .on(Mandate.mandate_id == Customer.custom_gocardless_mandate_id)
+            .select(
+                Subscription.name.as_("subscription"),
+                Subscription.customer,
+                Service.name.as_("service"),
+                Service.plan,
+                Service.quantity,
+                Service.price,
+                Service.billing_start_date,
+                Service.billing_end_date,
+                Service.pay_period,
+                Service.no_of_month,
+                Service.next_billing_date,
+                Plan.item,
+                Plan.plan_name,
+                Plan.currency,
+                Customer.custom_gocardless_mandate_id.as_("mandate_id"),
+                Mandate.status.as_("mandate_status"),
+                Customer.custom_stripe_payment_method_id.as_("stripe_payment_method")
+            )
+            .where(Service.status == "Active")
+            .where(Service.next_billing_date <= (billing_date or nowdate()))
+            .where(Ledger.name.isnull())
+            .where(IfNull(Plan.item, "") != "")
+            .orderby(Subscription.customer)
+            .orderby(Subscription.name)
+            .orderby(Service.idx)
+    )
 
-    subscriptions = cli_subscription_list()
-    if not subscriptions:
-        return {"success": False, "message": "No subscriptions found"}
-    
-    print("CLI Subscription", subscriptions)
+    if subscriptions:
+        query = query.where(Subscription.name.isin(subscriptions))
+
+    if shard_count:
+        query = query.where(Crc32(Subscription.customer) % shard_count == shard)
+
+    if after_customer:
+        query = query.where(Subscription.customer > after_customer)
+
+    return query.run(as_dict=True)
+
+
+
+def claim_billing_period(svc, customer):
+    """
+    Insert the ledger entry for the period a service row is about to be billed
+    for and return its name, or None if another run has already claimed it.
+    The unique (service, period_start) key is the idempotency key of billing:
+    a second insert for the same period waits for the first transaction and
+    then fails, whichever worker or button it came from.
+    """
+    period_start = get_billing_period_start(svc)
+
+    try:
+        entry = frappe.get_doc({
+            "doctype": "Subscription Billing Period",
+            "subscription": svc.subscription,
+            "customer": customer,
+            "service": svc.service,
+            "plan": svc.plan,
+            "period_start": period_start,
+            "period_end": get_billing_period_end(svc, period_start),
+            "billing_date": svc.next_billing_date,
+            "amount": flt(svc.quantity) * flt(svc.price)
+        }).insert(ignore_permissions=True)
+    except (frappe.UniqueValidationError, frappe.DuplicateEntryError):
+        frappe.clear_messages()
+        return None
+
+    return entry.name
+
+
+def skip_claimed_period(svc):
+    """
+    Move a row whose period has already been claimed on to its next unbilled
+    period, otherwise every later run would pick it up and fail the claim again.
+    """
+    next_billing_date = get_next_billing_date(svc, get_billing_period_start(svc))
+
+    frappe.db.set_value(
+        "Subscription Service",
+        svc.service,
+        "next_billing_date",
+        skip_billed_periods(svc, next_billing_date, get_billed_periods(svc.service))
+    )
 
-    created_invoices_all = []
 
-    for sub in subscriptions:
-        subscription = sub.get("name")
-        if not subscription:
-            continue
 
-        sub_doc = frappe.get_doc("CLI Subscription", subscription)
+def make_sales_invoice(customer, services, due_date=None):
+    """
+    Create and submit one Sales Invoice for the given billable service rows.
+    Rows whose period has already been claimed by another run are dropped;
+    returns the invoice and the rows it bills, or (None, []) if nothing is left.
+    """
+
+    # 🔹 Claim the periods first, so a concurrent or retried run becomes a no-op
+    claimed = {}
+    for svc in services:
+        entry = claim_billing_period(svc, customer)
+        if entry:
+            claimed[entry] = svc
+        else:
+            skip_claimed_period(svc)
+
+    if not claimed:
+        return None, []
+
+    si = frappe.new_doc("Sales Invoice")
+    si.customer = customer
+    si.posting_date = nowdate()
+    si.due_date = due_date or add_days(nowdate(), 7)   # 7 days ahead
+
+    for svc in claimed.values():
+        si.append("items", {
+            "item_code": svc.item,
+            "qty": svc.quantity,
+            "rate": svc.price
+        })
+
+    si.insert(ignore_permissions=True)
+    si.submit()
+
+    Ledger = DocType("Subscription Billing Period")
+    (
+        frappe.qb.update(Ledger)
+            .set(Ledger.sales_invoice, si.name)
+            .where(Ledger.name.isin(list(claimed)))
+    ).run()
+
+    for svc in claimed.values():
+        # 🔹 Keep the latest invoice on the service row and move it on to its next period,
+        # without re-saving the subscription
+        frappe.db.set_value("Subscription Service", svc.service, {
+            "sales_invoice_id": si.name,
+            "next_billing_date": get_next_billing_date(svc, get_billing_period_start(svc))
+        })
+
+    return si, list(claimed.values())
+
+
+
+@contextmanager
+def billing_lock(customer, timeout=10 * 60):
+    """
+    Short-lived redis lock around billing one customer. Yields False
+    without waiting when another worker holds it; the lock expires on its own
+    if that worker dies.
+    """
+
+    lock = frappe.cache.lock(
+        frappe.cache.make_key(f"isp_billing:billing_lock:{customer}"),
+        timeout=timeout
+    )
+    acquired = lock.acquire(blocking=False)
 
-        if not sub_doc.customer:
-            frappe.log_error(f"Customer missing in CLI Subscription {subscription}")
-            continue
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            try:
+                lock.release()
+            except LockError:
+                # expired while we were still billing; the ledger still protects the periods
+                pass
 
-        # get customer doc to fetch mandate id (if needed later)
-        customer_doc = frappe.get_doc("Customer", sub_doc.customer)
-        mandate_id = customer_doc.custom_gocardless_mandate_id
 
-        services = sub_doc.get("service") or []
-        created_invoices = []
 
-        for svc in services:
-            if svc.status != "Active":
-                continue
+def invoice_billable_services(services, due_date=None, consolidate=None):
+    """
+    Create the invoices for a set of billable service rows and group the results
+    by subscription. In consolidated mode all services of a customer go on one
+    Sales Invoice as separate item lines, otherwise each row gets its own.
+    """
+
+    if consolidate is None:
+        consolidate = cint(frappe.db.get_single_value("Isp Billing Setting", "consolidate_invoices"))
 
-            # ✅ Only create invoice if no invoice linked already
-            if svc.sales_invoice_id:
-                continue  
+    batches = {}
+    for svc in services:
+        batches.setdefault(svc.customer if consolidate else svc.service, []).append(svc)
 
-            # Fetch Subscription Plan to get item
-            plan = frappe.get_doc("Subscription Plan", svc.plan)
-            if not plan.item:
-                frappe.log_error(f"No Item linked in Subscription Plan {svc.plan}")
+    created = {}
+
+    for rows in batches.values():
+        si, billed = make_sales_invoice(rows[0].customer, rows, due_date)
+
+        for svc in billed:
+            created.setdefault(svc.subscription, []).append((si.name, svc.plan_name or svc.plan))
+
+    return [
+        {"subscription": subscription, "invoices": invoices}
+        for subscription, invoices in created.items()
+    ]
+
+
+
+def run_billing_shard(billing_run, shard=0, shard_count=None, subscriptions=None):
+    """
+    Invoice one shard of a Billing Run. Services are billed one customer at a
+    time, since a consolidated invoice spans all of a customer's subscriptions,
+    and a checkpoint is committed after every customer, so rerunning the same
+    Billing Run starts after the last customer it committed instead of
+    rescanning everything. Customers locked by another run or whose billing
+    failed are skipped, and the checkpoint stays before the first of them, so a
+    rerun retries them; customers billed after it are not billed twice, the
+    ledger leaves their services out.
+    """
+
+    checkpoint = start_shard(billing_run, shard)
+    services = get_billable_services(subscriptions, shard, shard_count, after_customer=checkpoint)
+    consolidate = cint(frappe.db.get_single_value("Isp Billing Setting", "consolidate_invoices"))
+
+    created = []
+    # the checkpoint only moves while every customer so far has been billed
+    advance = True
+
+    for customer, rows in groupby(services, key=lambda svc: svc.customer):
+        with billing_lock(customer) as locked:
+            if not locked:
+                advance = False
                 continue
 
-            # Create Sales Invoice
-            si = frappe.new_doc("Sales Invoice")
-            si.customer = sub_doc.customer
-            si.posting_date = nowdate()
-            si.due_date = add_days(nowdate(), 7)   # 7 days ahead
+            try:
+                invoices = invoice_billable_services(list(rows), consolidate=consolidate)
+            except Exception as e:
+                frappe.db.rollback()
+                frappe.log_error(frappe.get_traceback(), f"Invoice generation failed for {customer}")
+                record_error(billing_run, shard, customer, str(e))
+                frappe.db.commit()
+                advance = False
+                continue
 
-            si.append("items", {
-                "item_code": plan.item,
-                "qty": svc.quantity,
-                "rate": svc.price
-            })
+            created.extend(invoices)
+            invoice_count = len({si for row in invoices for si, _ in row["invoices"]})
+            record_checkpoint(billing_run, shard, customer, invoice_count, advance=advance)
+            frappe.db.commit()
+            store_billing_result(billing_run, shard, customer, invoices)
 
-            si.insert(ignore_permissions=True)
-            si.submit()
-            created_invoices.append((si.name, plan.plan_name or plan.name))
+    finish_shard(billing_run, shard)
+    frappe.db.commit()
 
-            # 🔹 Save Sales Invoice ID in service row
-            svc.sales_invoice_id = si.name
+    return created
 
-        # 🔹 Save subscription so child table updates
-        sub_doc.save(ignore_permissions=True)
 
-        if created_invoices:
-            created_invoices_all.append({
-                "subscription": subscription,
-                "invoices": created_invoices
-            })
 
-    return {"success": True, "created": created_invoices_all}
+@frappe.whitelist()
+def create_invoices_for_all_subscriptions():
+    """Create invoices for all CLI Subscriptions"""
 
+    settings = frappe.get_single("Isp Billing Setting")
+    shard_count = max(cint(settings.billing_shards), 1)
 
+    billing_run = get_billing_run("Scheduled", shard_count)
 
+    if shard_count > 1:
+        return enqueue_sharded_billing(billing_run, settings.billing_queue or "long")
 
+    created = run_billing_shard(billing_run.name)
 
+    return {"success": True, "created": created, "billing_run": billing_run.name}
 
 
 
+"""
+Sharded billing: the daily run is split by customer into N background jobs so
+invoice generation can use every billing worker. Progress is checkpointed on
+the Billing Run, and each shard keeps the invoices it created in the cache,
+per customer as they are committed, so get_sharded_billing_result can put
+them back together even after a shard was interrupted and resumed.
+"""
 
+# seconds the per-customer results of a billing run are kept in the cache
+BILLING_RESULT_TTL = 3 * 24 * 60 * 60
 
 
+def get_billing_run_key(billing_run):
+    return f"isp_billing:billing_run:{billing_run}"
 
-@frappe.whitelist()
-def cleanup_paid_invoices():
 
-    subscriptions = cli_subscription_list()
-    if not subscriptions:
-        return {"success": False, "message": "No subscriptions found"}
-    
-    print("CLI Subscription", subscriptions)
+def store_billing_result(billing_run, shard, customer, invoices):
+    """Add the invoices committed for one customer to the cached result of the run"""
 
-    for sub in subscriptions:
-        subscription = sub.get("name")
-        if not subscription:
-            continue
+    if not invoices:
+        return
 
+    key = get_billing_run_key(billing_run)
+    field = f"shard:{shard}:{customer}"
 
-    """Remove sales_invoice_id from subscription services if invoice is already paid"""
-    subscription = frappe.get_doc("CLI Subscription", subscription)
-    updated_rows = []
+    # a resumed shard adds to what it created for the customer before it was interrupted
+    frappe.cache.hset(key, field, (frappe.cache.hget(key, field) or []) + invoices)
+    frappe.cache.expire(frappe.cache.make_key(key), BILLING_RESULT_TTL)
 
-    for svc in subscription.get("service") or []:
-        if not svc.sales_invoice_id:
+
+def enqueue_sharded_billing(billing_run, queue="long"):
+    """Enqueue one billing job for every shard of the run that has not completed yet"""
+
+    for row in billing_run.shards:
+        if row.status == "Completed":
             continue
 
-        inv = frappe.db.get_value(
-            "Sales Invoice",
-            svc.sales_invoice_id,
-            ["status", "custom_gocardless_payment_status"],
-            as_dict=True
+        frappe.enqueue(
+            "isp_billing.api.sales_invoice.create_invoices_for_shard",
+            queue=queue,
+            timeout=4 * 60 * 60,
+            job_id=f"isp_billing_invoice_shard::{billing_run.name}::{row.shard}",
+            deduplicate=True,
+            billing_run=billing_run.name,
+            shard=row.shard,
+            shard_count=billing_run.shard_count
         )
 
-        if not inv:
-            continue
+    return {"success": True, "billing_run": billing_run.name, "shards": billing_run.shard_count}
 
-        # ✅ check conditions
-        if inv.status == "Paid" or inv.custom_gocardless_payment_status in ["paid", "paid_out", "Paid", "Paid Out", "Paid out"]:
-            frappe.db.set_value(
-                "Subscription Service",
-                svc.name,
-                "sales_invoice_id",
-                None
-            )
-            updated_rows.append(svc.sales_invoice_id)
+
+def create_invoices_for_shard(billing_run, shard, shard_count):
+    """Background job: invoice every billable service of one customer shard"""
+
+    try:
+        run_billing_shard(billing_run, shard, shard_count)
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error(frappe.get_traceback(), f"Billing shard {shard} of {billing_run} failed")
+        finish_shard(billing_run, shard, status="Failed")
+        frappe.db.commit()
+
+
+@frappe.whitelist()
+def get_sharded_billing_result(billing_run):
+    """Aggregate the per-shard results of a sharded run into the serial run's shape"""
+
+    run = frappe.get_doc("Billing Run", billing_run)
+    results = frappe.cache.hgetall(get_billing_run_key(billing_run)) or {}
 
     return {
-        "success": True,
-        "cleared_invoices": updated_rows
+        "success": run.status == "Completed",
+        "created": [row for key in sorted(results) for row in results[key]],
+        "pending_shards": [row.shard for row in run.shards if row.status in ("Pending", "Running")],
+        "errors": [
+            {"customer": row.customer, "shard": row.shard, "error": row.error}
+            for row in run.errors
+        ]
     }
 
 
+
+# GoCardless payment statuses that mean the invoice has been collected, after
+# lower-casing and replacing spaces ("Paid Out" -> "paid_out")
+PAID_GATEWAY_STATUSES = ("paid", "paid_out")
+
+
+@frappe.whitelist()
+def cleanup_paid_invoices():
+    """Remove sales_invoice_id from subscription services if invoice is already paid"""
+
+    Service = DocType("Subscription Service")
+    SalesInvoice = DocType("Sales Invoice")
+
+    gateway_status = Lower(Replace(IfNull(SalesInvoice.custom_gocardless_payment_status, ""), " ", "_"))
+
+    rows = (
+        frappe.qb.from_(Service)
+            .join(SalesInvoice)
+            .on(SalesInvoice.name == Service.sales_invoice_id)
+            .select(Service.name, Service.sales_invoice_id)
+            .where(Service.parenttype == "CLI Subscription")
+            .where((SalesInvoice.status == "Paid") | gateway_status.isin(PAID_GATEWAY_STATUSES))
+    ).run(as_dict=True)
+
+    # 🔹 Clear the links in a handful of batched UPDATEs instead of one per row
+    for batch in create_batch(rows, 1000):
+        (
+            frappe.qb.update(Service)
+                .set(Service.sales_invoice_id, None)
+                .where(Service.name.isin([row.name for row in batch]))
+        ).run()
+
+    return {
+        "success": True,
+        "cleared": len(rows),
+        "cleared_invoices": [row.sales_invoice_id for row in rows]
+    }
@@ -1,22 +1,80 @@
 import frappe
 import stripe
 import json
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from frappe import _
+from requests.adapters import HTTPAdapter
+
+from isp_billing.api.customer import get_email_key
+from isp_billing.api.payment_preflight import get_charge_instructions, get_payment_idempotency_key
+from isp_billing.isp_billing.doctype.stripe_webhook_event.stripe_webhook_event import (
+    get_last_applied,
+    get_pending_events,
+    insert_webhook_events,
+    set_event_status,
+)
+
+"""
+Shared Stripe client: one stripe.StripeClient per worker process and site,
+carrying its own API key and a pooled keep-alive HTTP session, so requests
+never touch the module-global stripe.api_key and skip the TLS handshake.
+"""
+
+# seconds to connect / to wait for a response from the Stripe API
+STRIPE_TIMEOUT = (5, 30)
+
+# retries of network errors and 409/429/5xx responses, with Stripe's backoff and idempotency keys
+STRIPE_MAX_NETWORK_RETRIES = 2
+
+_stripe_clients = {}
+
 
 def get_stripe_client():
-    """Initialize Stripe with the secret key from Virtual Hospital Setting"""
-    settings = frappe.get_single("Isp Billing Setting")
+    """
+    Return the StripeClient for the current site, built from Isp Billing
+    Setting, or None if no Stripe Secret Key is set. It is cached per process
+    and rebuilt when the key or API base changes.
+    """
 
-    if not settings or not settings.stripe_secret_key or not settings.stripe_publish_key:
-        return None  # Clearly return None if any key is missing
-    
-    stripe.api_key = settings.stripe_secret_key
-    return stripe
+    settings = frappe.get_cached_doc("Isp Billing Setting")
+    if not settings.stripe_secret_key:
+        return None
+
+    # site_config override, e.g. to point a scratch site at the benchmark gateway stub
+    api_base = frappe.conf.get("isp_billing_stripe_api_base")
+    key = (settings.stripe_secret_key, api_base)
+
+    cached = _stripe_clients.get(frappe.local.site)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    if cached:
+        cached[2].close()
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=20)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    client = stripe.StripeClient(
+        settings.stripe_secret_key,
+        base_addresses={"api": api_base} if api_base else None,
+        max_network_retries=STRIPE_MAX_NETWORK_RETRIES,
+        http_client=stripe.RequestsClient(timeout=STRIPE_TIMEOUT, session=session)
+    )
 
-#get access token 
-def get_stripe_secret_key():
-    secret_key = frappe.get_single("Isp Billing Setting")
-    return secret_key
+    _stripe_clients[frappe.local.site] = (key, client, session)
+    return client
+
+
+def clear_stripe_client():
+    """Drop the cached client of the current site, e.g. after Isp Billing Setting is saved"""
+    cached = _stripe_clients.pop(frappe.local.site, None)
+    if cached:
+        cached[2].close()
 
 
 
@@ -36,64 +94,32 @@ def stripe_direct_debit_for_sales_invoice(sales_invoice_name):
     Customer's Stripe details (customer_id + payment_method_id).
     """
 
-    secret_key = get_stripe_secret_key()
-    stripe.api_key = secret_key.get("stripe_secret_key")
-
     try:
-        # 1. Get Sales Invoice
-        si = frappe.get_doc("Sales Invoice", sales_invoice_name)
-
-        # 2. Get linked Customer
-        customer = frappe.get_doc("Customer", si.customer)
-
-        # 3. Fetch Stripe IDs from Customer custom fields
-        customer_id = customer.custom_stripe_customer_id
-        payment_method = customer.custom_stripe_payment_method_id
-
-        if not customer_id or not payment_method:
-            frappe.throw("Stripe Customer ID or Payment Method ID is missing for this Customer.")
-
-        # 4. Amount from Sales Invoice (convert to cents for Stripe)
-        amount = int(si.outstanding_amount * 100)  # Stripe expects amount in cents
-
-        # 5. Create PaymentIntent
-        payment_intent = stripe.PaymentIntent.create(
-            amount=amount,
-            currency="usd",
-            customer=customer_id,
-            payment_method=payment_method,
-            off_session=True,
-            confirm=True,
-            automatic_payment_methods={
-                "enabled": True,
-                "allow_redirects": "never",
-            },
-        )
+        client = get_stripe_client()
+        if not client:
+            frappe.throw(_("Stripe Secret Key is not set in Isp Billing Setting"))
 
-        # ✅ 6. Update Sales Invoice with PaymentIntent details
-        si.db_set("custom_stripe_payment_id", payment_intent.id)
-        si.db_set("custom_stripe_payment_status", payment_intent.status)
+        # 1. Resolve amount, currency and the customer's Stripe ids in one query
+        instructions, rejected = get_charge_instructions([sales_invoice_name], "Stripe")
+        if rejected:
+            frappe.throw(rejected[0]["error"])
 
-        si.reload()
+        instruction = instructions[0]
 
-        if payment_intent.status == "succeeded":
-            print("psyment intent status", payment_intent.status)
-            payment_confirmation = frappe.get_doc("Email Template", "Payment Confirmation")
-
-            context = {
-                "customer": customer.name,
-                "amount": amount,
-                "invoice_number": sales_invoice_name
-            }
+        # 2. Create PaymentIntent, in the invoice currency and minor units
+        payment_intent = client.v1.payment_intents.create(
+            get_payment_intent_params(instruction),
+            {"idempotency_key": get_payment_idempotency_key(instruction)}
+        )
 
-            subject = frappe.render_template(payment_confirmation.subject, context)
-            message = frappe.render_template(payment_confirmation.response, context)
+        # ✅ 3. Update Sales Invoice with PaymentIntent details
+        frappe.db.set_value("Sales Invoice", sales_invoice_name, {
+            "custom_stripe_payment_id": payment_intent.id,
+            "custom_stripe_payment_status": payment_intent.status
+        })
 
-            frappe.sendmail(
-                recipients=customer.custom_email,
-                subject=subject,
-                message=message
-            )
+        if payment_intent.status == "succeeded":
+            send_payment_confirmations([instruction])
 
         return {
             "status": "success",
@@ -101,92 +127,369 @@ def stripe_direct_debit_for_sales_invoice(sales_invoice_name):
             "payment_intent_id": payment_intent.id
         }
 
+    except stripe.CardError as e:
+        # declined: keep the PaymentIntent on the invoice, so a retry gets a new key
+        payment_intent = e.error.payment_intent if e.error else None
+        if payment_intent:
+            frappe.db.set_value("Sales Invoice", sales_invoice_name, {
+                "custom_stripe_payment_id": payment_intent.id,
+                "custom_stripe_payment_status": payment_intent.status
+            })
+
+        return {
+            "status": "error",
+            "message": e.user_message or str(e),
+            "payment_status": payment_intent.status if payment_intent else None,
+            "payment_intent_id": payment_intent.id if payment_intent else None
+        }
+
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), "Stripe Direct Debit for Sales Invoice Error")
         return {"status": "error", "message": str(e)}
 
 
 
+def get_payment_intent_params(instruction):
+    """Off-session PaymentIntent for an invoice, in the invoice currency and minor units"""
+    return {
+        "amount": instruction.amount_minor,
+        "currency": (instruction.currency or "usd").lower(),
+        "customer": instruction.stripe_customer_id,
+        "payment_method": instruction.stripe_payment_method,
+        "off_session": True,
+        "confirm": True,
+        "automatic_payment_methods": {
+            "enabled": True,
+            "allow_redirects": "never",
+        },
+        "metadata": {
+            "erpnext_invoice": instruction.invoice,
+            "customer": instruction.customer
+        }
+    }
+
+
+def send_payment_confirmations(instructions):
+    """Queue the Payment Confirmation email for charged invoices"""
+
+    instructions = [instruction for instruction in instructions if instruction.email]
+    if not instructions:
+        return
+
+    payment_confirmation = frappe.get_doc("Email Template", "Payment Confirmation")
+
+    for instruction in instructions:
+        context = {
+            "customer": instruction.customer,
+            "amount": instruction.amount,
+            "invoice_number": instruction.invoice
+        }
+
+        frappe.sendmail(
+            recipients=instruction.email,
+            subject=frappe.render_template(payment_confirmation.subject, context),
+            message=frappe.render_template(payment_confirmation.response, context)
+        )
+
+
+
+@frappe.whitelist()
+def bulk_create_stripe_payments(invoices):
+    """
+    Charge multiple Sales Invoices off-session through Stripe in a background
+    job. Progress and the final results are published to the calling user as
+    "stripe_payment_progress" realtime events.
+    invoices: list of Sales Invoice names
+    """
+    if isinstance(invoices, str):
+        invoices = frappe.parse_json(invoices)
+
+    job_id = f"isp_billing_stripe_payments::{frappe.generate_hash(length=10)}"
+
+    frappe.enqueue(
+        "isp_billing.api.stripe.create_stripe_payments",
+        queue="long",
+        timeout=2 * 60 * 60,
+        job_id=job_id,
+        invoices=invoices,
+        user=frappe.session.user,
+        progress_id=job_id
+    )
+
+    return {"success": True, "job_id": job_id, "queued": len(invoices)}
 
 
 
 """
-This code is used in the stripe webhook to update the status of specific sales_invoice field
-custom_stirpe_payment_status
+Bulk charging: PaymentIntents are created from a bounded thread pool over the
+shared client, paced by a token bucket because Stripe sends no rate limit
+headers. Threads only talk to Stripe; reading the invoices and writing the
+results back stays on the job's own database connection.
 """
+
+# parallel payment_intents.create calls per job
+STRIPE_PAYMENT_WORKERS = 8
+
+# stay under Stripe's per-account limit (100/s live, 25/s in test mode)
+STRIPE_REQUESTS_PER_SECOND = 20
+
+# publish progress after this many payments
+STRIPE_PROGRESS_EVERY = 25
+
+
+class TokenBucket:
+    """Lets at most `rate` requests per second through, across threads"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.updated = time.monotonic()
+                self.tokens = 0
+            else:
+                self.tokens -= 1
+
+
+def create_stripe_payments(invoices, user=None, progress_id=None):
+    """Background job behind bulk_create_stripe_payments"""
+
+    # 🔹 One query for every invoice; ineligible ones never reach the API
+    payable, results = get_charge_instructions(invoices, "Stripe")
+    for res in results:
+        res["success"] = False
+
+    client = get_stripe_client()
+    if not client:
+        frappe.log_error("Set the Stripe Secret Key in Isp Billing Setting", "Stripe Bulk Payment Error")
+        payable = []
+
+    bucket = TokenBucket(STRIPE_REQUESTS_PER_SECOND)
+
+    def create_payment_intent(instruction):
+        bucket.wait()
+        try:
+            return client.v1.payment_intents.create(
+                get_payment_intent_params(instruction),
+                {"idempotency_key": get_payment_idempotency_key(instruction)}
+            )
+        except stripe.RateLimitError:
+            # the same idempotency key makes the retry safe
+            time.sleep(1)
+            return client.v1.payment_intents.create(
+                get_payment_intent_params(instruction),
+                {"idempotency_key": get_payment_idempotency_key(instruction)}
+            )
+
+    updates = {}
+    succeeded = []
+
+    with ThreadPoolExecutor(max_workers=STRIPE_PAYMENT_WORKERS) as executor:
+        futures = {executor.submit(create_payment_intent, instruction): instruction for instruction in payable}
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            instruction = futures[future]
+            try:
+                payment_intent = future.result()
+            except stripe.CardError as e:
+                # declined: the PaymentIntent exists and is stored, so a retry gets a new key
+                results.append({"invoice": instruction.invoice, "success": False, "error": e.user_message or str(e)})
+                if e.error and e.error.payment_intent:
+                    updates[instruction.invoice] = {
+                        "custom_stripe_payment_id": e.error.payment_intent.id,
+                        "custom_stripe_payment_status": e.error.payment_intent.status
+                    }
+            except Exception as e:
+                frappe.log_error(f"{instruction.invoice}: {e}", "Stripe Bulk Payment Error")
+                results.append({"invoice": instruction.invoice, "success": False, "error": str(e)})
+            else:
+                updates[instruction.invoice] = {
+                    "custom_stripe_payment_id": payment_intent.id,
+                    "custom_stripe_payment_status": payment_intent.status
+                }
+                results.append({"invoice": instruction.invoice, "success": True, "payment_id": payment_intent.id})
+                if payment_intent.status == "succeeded":
+                    succeeded.append(instruction)
+
+            if done % STRIPE_PROGRESS_EVERY == 0:
+                publish_payment_progress(progress_id, user, done, len(payable), results)
+
+    # 🔹 Store every PaymentIntent on its invoice in one write, then queue the emails
+    frappe.db.bulk_update("Sales Invoice", updates)
+    send_payment_confirmations(succeeded)
+    frappe.db.commit()
+
+    publish_payment_progress(progress_id, user, len(payable), len(payable), results, finished=True)
+
+    return results
+
+
+def publish_payment_progress(progress_id, user, done, total, results, finished=False):
+    message = {
+        "job_id": progress_id,
+        "done": done,
+        "total": total,
+        "succeeded": sum(1 for res in results if res["success"]),
+        "failed": sum(1 for res in results if not res["success"]),
+        "finished": finished
+    }
+    if finished:
+        message["results"] = results
+
+    frappe.publish_realtime("stripe_payment_progress", message, user=user, after_commit=False)
+
+
+
+"""
+Stripe webhook: the request only verifies the signature and stores the event
+in Stripe Webhook Event; a background job applies the stored events to the
+Sales Invoices in batches.
+"""
+
+# PaymentIntent statuses a PaymentIntent never leaves
+STRIPE_FINAL_STATUSES = ("succeeded", "canceled")
+
+STRIPE_PAYMENT_EVENTS = (
+    "payment_intent.succeeded",
+    "payment_intent.processing",
+    "payment_intent.payment_failed",
+    "payment_intent.canceled"
+)
+
+
 @frappe.whitelist(allow_guest=True)
 def stripe_webhook():
     """
-    Stripe webhook to update Sales Invoice payment status
-    based on Stripe PaymentIntent events.
+    Webhook endpoint for Stripe.
+    Verifies the signature against the Stripe Webhook Secret of Isp Billing
+    Setting and stores the event; duplicate deliveries hit the unique event id.
     """
 
-    # Get Stripe settings
-    secret_key = get_stripe_secret_key()
-    stripe.api_key = secret_key.get("stripe_secret_key")
-
-    # Your webhook signing secret stored in a DocType
-    #remove the webhook secret from the code
-    # endpoint_secret = frappe.db.get_single_value("Stripe Settings", "webhook_secret")
-    endpoint_secret = ""
+    endpoint_secret = frappe.db.get_single_value("Isp Billing Setting", "stripe_webhook_secret")
+    if not endpoint_secret:
+        frappe.log_error("Set the Stripe Webhook Secret in Isp Billing Setting", "Stripe Webhook Rejected")
+        frappe.local.response["http_status_code"] = 400
+        return "Webhook secret not configured"
 
     payload = frappe.request.data
     sig_header = frappe.get_request_header("Stripe-Signature")
 
-    event = None
-
-    # Verify webhook
+    # ✅ Verify webhook
     try:
-        if endpoint_secret:
-            event = stripe.Webhook.construct_event(
-                payload, sig_header, endpoint_secret
-            )
-        else:
-            event = json.loads(payload)
+        stripe.Webhook.construct_event(payload, sig_header, endpoint_secret)
     except ValueError as e:
         frappe.log_error(str(e), "⚠️ Webhook JSON Parse Error")
         frappe.local.response["http_status_code"] = 400
         return "Invalid payload"
-    except stripe.error.SignatureVerificationError as e:
+    except stripe.SignatureVerificationError as e:
         frappe.log_error(str(e), "⚠️ Webhook Signature Verification Failed")
         frappe.local.response["http_status_code"] = 400
         return "Invalid signature"
 
-    # --- Handle events ---
-    if event and event["type"] in [
-        "payment_intent.succeeded",
-        "payment_intent.processing",
-        "payment_intent.payment_failed"
-    ]:
-        payment_intent = event["data"]["object"]
-        payment_intent_id = payment_intent.get("id")
-        status = payment_intent.get("status")
-
-        # Find Sales Invoice where custom_stripe_payment_id = payment_intent.id
-        sales_invoice = frappe.db.get_value(
-            "Sales Invoice",
-            {"custom_stripe_payment_id": payment_intent_id},
-            "name"
-        )
+    insert_webhook_events([json.loads(payload)])
+    enqueue_stripe_event_processing()
 
-        if sales_invoice:
-            frappe.db.set_value(
-                "Sales Invoice",
-                sales_invoice,
-                "custom_stripe_payment_status",
-                status
-            )
-            frappe.db.commit()
-            frappe.logger().info(f"✅ Updated {sales_invoice} with Stripe status: {status}")
+    return "Webhook received"
+
+
+
+def enqueue_stripe_event_processing():
+    frappe.enqueue(
+        "isp_billing.api.stripe.process_stripe_webhook_events",
+        queue="short",
+        job_id="isp_billing_stripe_webhook_events",
+        deduplicate=True,
+        enqueue_after_commit=True
+    )
+
+
+
+def process_stripe_webhook_events():
+    """
+    Background job: apply every pending Stripe Webhook Event, oldest first,
+    one batch per transaction. Also scheduled hourly to pick up events whose
+    job was lost.
+    """
+
+    while True:
+        events = get_pending_events()
+        if not events:
+            break
+
+        payment_events = [event for event in events if event.event_type in STRIPE_PAYMENT_EVENTS]
+
+        try:
+            apply_stripe_payment_events(payment_events)
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(frappe.get_traceback(), "Stripe payment events failed")
+            failed = [event.name for event in payment_events]
+            set_event_status(failed, "Failed", frappe.get_traceback())
+            # the rest of the batch is unaffected and not left pending
+            set_event_status([event.name for event in events if event.name not in failed], "Processed")
         else:
-            frappe.logger().warning(
-                f"⚠️ No Sales Invoice found for PaymentIntent {payment_intent_id}"
-            )
+            set_event_status([event.name for event in events], "Processed")
+
+        frappe.db.commit()
+
+
+
+def apply_stripe_payment_events(events):
+    """
+    Update the Sales Invoices of a batch of PaymentIntent events in one bulk
+    write. Events are applied by their Stripe created time: one older than an
+    event already applied to the same PaymentIntent is skipped, and a final
+    status (succeeded, canceled) is never overwritten, so a late processing
+    event cannot undo a succeeded payment.
+    """
+
+    if not events:
+        return
+
+    last_applied = get_last_applied({event.resource_id for event in events})
+
+    # 🔹 Latest status per PaymentIntent; events come oldest first
+    payment_intents = {}
+    for event in events:
+        applied = last_applied.get(event.resource_id)
+        if applied and event.event_created_at < applied:
+            continue
+
+        status = json.loads(event.payload)["data"]["object"].get("status")
+        current = payment_intents.get(event.resource_id)
 
-    else:
-        frappe.logger().info(f"Unhandled event type {event['type']}")
+        # same-second events: a final status wins
+        if current and current["created"] == event.event_created_at and current["status"] in STRIPE_FINAL_STATUSES:
+            continue
 
-    return "Webhook processed"
+        payment_intents[event.resource_id] = {"status": status, "created": event.event_created_at}
+
+    if not payment_intents:
+        return
+
+    updates = {}
+    for si in frappe.get_all(
+        "Sales Invoice",
+        filters={"custom_stripe_payment_id": ["in", list(payment_intents)]},
+        fields=["name", "custom_stripe_payment_id", "custom_stripe_payment_status"]
+    ):
+        if si.custom_stripe_payment_status in STRIPE_FINAL_STATUSES:
+            continue
+
+        status = payment_intents[si.custom_stripe_payment_id]["status"]
+        if status != si.custom_stripe_payment_status:
+            updates[si.name] = {"custom_stripe_payment_status": status}
+
+    frappe.db.bulk_update("Sales Invoice", updates)
 
 
 
@@ -202,39 +505,43 @@ def create_customer_and_payment_method(email, name, payment_method_id):
     and updates the corresponding Frappe Customer record.
     """
 
-    secret_key = get_stripe_secret_key()
-    stripe.api_key = secret_key.get("stripe_secret_key")
-
     try:
+        client = get_stripe_client()
+        if not client:
+            frappe.throw(_("Stripe Secret Key is not set in Isp Billing Setting"))
+
         # 1. Create Customer in Stripe
-        customer = stripe.Customer.create(
-            email=email,
-            name=name,
-        )
+        customer = client.v1.customers.create({
+            "email": email,
+            "name": name,
+        })
 
         # 2. Attach the payment method
-        stripe.PaymentMethod.attach(
+        client.v1.payment_methods.attach(
             payment_method_id,
-            customer=customer.id
+            {"customer": customer.id}
         )
 
         # 3. Set default payment method
-        stripe.Customer.modify(
+        client.v1.customers.update(
             customer.id,
-            invoice_settings={
-                "default_payment_method": payment_method_id
+            {
+                "invoice_settings": {
+                    "default_payment_method": payment_method_id
+                }
             }
         )
 
-        # 4. Update Frappe Customer (where custom_email = email)
-        frappe.db.set_value(
-            "Customer",
-            {"custom_email": email},  # filter condition
-            {
-                "custom_stripe_customer_id": customer.id,
-                "custom_stripe_payment_method_id": payment_method_id,
-            },
-        )
+        # 4. Update Frappe Customer, matched on the indexed, normalised email
+        if get_email_key(email):
+            frappe.db.set_value(
+                "Customer",
+                {"custom_email_key": get_email_key(email)},  # filter condition
+                {
+                    "custom_stripe_customer_id": customer.id,
+                    "custom_stripe_payment_method_id": payment_method_id,
+                },
+            )
 
         frappe.db.commit()  # ensure the update is saved
 
@@ -284,12 +591,12 @@ def create_payment_intent(amount:int, currency:str="usd"):
             }
         amount_in_cents = int(float(amount) * 100)  # Convert to cents
 
-        intent = stripe_client.PaymentIntent.create(
-            amount=amount_in_cents,
-            currency=currency,
-            # payment_method="pm_card_visa",
-            payment_method_types=["card"]
-        )
+        intent = stripe_client.v1.payment_intents.create({
+            "amount": amount_in_cents,
+            "currency": currency,
+            # "payment_method": "pm_card_visa",
+            "payment_method_types": ["card"]
+        })
 
         frappe.local.response.http_status_code = 201
         return {
@@ -315,8 +622,7 @@ def confirm_payment(payment_intent_id):
     """Optionally confirm a Stripe PaymentIntent (usually handled by frontend)"""
     try:
         stripe_client = get_stripe_client()
-        intent = stripe_client.PaymentIntent.retrieve(payment_intent_id)
-        confirmed_intent = intent.confirm()
+        confirmed_intent = stripe_client.v1.payment_intents.confirm(payment_intent_id)
 
         frappe.local.response.http_status_code = 201
 
@@ -350,9 +656,9 @@ def create_stripe_checkout_link(amount, customer_email, enhancement_id):
 
 
         # Create Stripe Checkout Session
-        session = stripe_client.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
+        session = stripe_client.v1.checkout.sessions.create({
+            'payment_method_types': ['card'],
+            'line_items': [{
                 'price_data': {
                     'currency': 'usd',
                     'product_data': {
@@ -362,14 +668,14 @@ def create_stripe_checkout_link(amount, customer_email, enhancement_id):
                 },
                 'quantity': 1,
             }],
-            mode='payment',
-            customer_email=customer_email,
-            success_url=success_url,
-            cancel_url=cancel_url,
-            metadata={
+            'mode': 'payment',
+            'customer_email': customer_email,
+            'success_url': success_url,
+            'cancel_url': cancel_url,
+            'metadata': {
                 f"{enhancement_id}_id": enhancement_id
             }
-        )
+        })
 
         return {
             "checkout_url": session.url,
@@ -0,0 +1,68 @@
+"""
+Stripe reconciliation sweep: Stripe cannot list PaymentIntents by update
+time, but every status change is an event, so the payment_intent.* events
+created since the stored cursor are listed instead and replayed through the
+Stripe Webhook Event store. Events whose webhook did arrive are skipped by
+the unique event id; the rest update their invoices in the usual batched,
+ordered job.
+"""
+
+import frappe
+from frappe.utils import add_days, now_datetime
+
+from isp_billing.api.stripe import STRIPE_PAYMENT_EVENTS, enqueue_stripe_event_processing, get_stripe_client
+from isp_billing.isp_billing.doctype.billing_sync_cursor.billing_sync_cursor import (
+	get_sync_cursor,
+	set_sync_cursor,
+)
+from isp_billing.isp_billing.doctype.stripe_webhook_event.stripe_webhook_event import insert_webhook_events
+
+PAGE_SIZE = 100
+
+# Stripe keeps events for 30 days, the first sweep covers all of them
+INITIAL_SYNC_DAYS = 30
+
+
+def sync_stripe_payment_events():
+	"""Scheduled job: store every PaymentIntent event created since the last sweep"""
+
+	client = get_stripe_client()
+	if not client:
+		return
+
+	cursor = get_sync_cursor("Stripe", "events")
+	since = int(cursor) if cursor else int(add_days(now_datetime(), -INITIAL_SYNC_DAYS).timestamp())
+
+	newest = since
+	count = 0
+	page = []
+
+	# newest first; the cursor only moves once every event has been stored
+	for event in client.v1.events.list(
+		{"types": list(STRIPE_PAYMENT_EVENTS), "created": {"gte": since}, "limit": PAGE_SIZE}
+	).auto_paging_iter():
+		page.append(event.to_dict())
+		newest = max(newest, event.created)
+
+		if len(page) == PAGE_SIZE:
+			count += store_events(page)
+			page = []
+
+	count += store_events(page)
+
+	set_sync_cursor("Stripe", "events", str(newest), count)
+	frappe.db.commit()
+
+	if count:
+		enqueue_stripe_event_processing()
+
+	return count
+
+
+def store_events(events):
+	if not events:
+		return 0
+
+	insert_webhook_events(events)
+	frappe.db.commit()
+	return len(events)
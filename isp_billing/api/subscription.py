@@ -200,50 +200,18 @@ def get_subscription_invoice():
 
 
 def clear_sales_invoice_ids_monthly():
-    Subscription = DocType("CLI Subscription")
-    Service = DocType("Subscription Service")
-
-    raw_data = (
-        frappe.qb.from_(Subscription)
-        .join(Service).on(Subscription.name == Service.parent)
-        .select(
-            Subscription.name,
-            Subscription.customer,
-            Service.name.as_("service_name"),  # child row identifier
-            Service.plan,
-            Service.sales_invoice_id
-        )
-        .run(as_dict=True)
-    )
-
-    subscriptions = {}
-    for row in raw_data:
-        sub_name = row["name"]
-        customer = row["customer"]
-
-        if sub_name not in subscriptions:
-            subscriptions[sub_name] = {
-                "name": sub_name,
-                "customer": customer,
-                "plans": []
-            }
-
-        subscriptions[sub_name]["plans"].append({
-            "plan": row["plan"],
-            "sales_invoice_id": row["sales_invoice_id"],
-            "service_name": row["service_name"]
-        })
-
-    # 🔹 Remove sales_invoice_id from all plans
-    for sub in subscriptions.values():
-        doc = frappe.get_doc("CLI Subscription", sub["name"])
-
-        for service in doc.service:  # child table
-            service.sales_invoice_id = None
-
-        doc.save(ignore_permissions=True)
-
-    return list(subscriptions.values())
-
+    """
+    Clear the latest-invoice link on every service row in one UPDATE.
 
+    No longer scheduled: billing eligibility comes from next_billing_date and the
+    Subscription Billing Period ledger, so the links no longer need resetting
+    each month. Kept for sites that still want to blank them by hand.
+    """
+    Service = DocType("Subscription Service")
 
+    (
+        frappe.qb.update(Service)
+            .set(Service.sales_invoice_id, None)
+            .where(Service.parenttype == "CLI Subscription")
+            .where(Service.sales_invoice_id.isnotnull())
+    ).run()
@@ -0,0 +1,142 @@
+"""
+Benchmark the billing entry points against a generated dataset.
+
+Each entry point is timed and its database work counted by wrapping
+frappe.db.sql for the duration of the call. The report is plain JSON so the
+numbers of two releases can be diffed.
+"""
+
+import resource
+import time
+from contextlib import contextmanager
+
+import frappe
+from frappe.query_builder import DocType
+from frappe.utils import create_batch
+
+from isp_billing.benchmarks.dataset import DEFAULT_PREFIX, delete_dataset, make_dataset
+
+WRITE_STATEMENTS = ("insert", "update", "delete", "replace")
+
+
+class Metrics:
+	def __init__(self):
+		self.queries = 0
+		self.rows_written = 0
+		self.wall_time = 0.0
+
+	def as_dict(self):
+		return {
+			"wall_time_s": round(self.wall_time, 3),
+			"queries": self.queries,
+			"rows_written": self.rows_written,
+			"peak_rss_mb": round(get_peak_rss_mb(), 1),
+		}
+
+
+@contextmanager
+def measure():
+	"""Count queries, written rows and wall time of everything run inside the block"""
+	metrics = Metrics()
+	db = frappe.local.db
+	original_sql = db.sql
+
+	def counting_sql(query, *args, **kwargs):
+		result = original_sql(query, *args, **kwargs)
+		metrics.queries += 1
+		if str(query).lstrip().lower().startswith(WRITE_STATEMENTS):
+			metrics.rows_written += max(db._cursor.rowcount, 0)
+		return result
+
+	db.sql = counting_sql
+	start = time.perf_counter()
+	try:
+		yield metrics
+	finally:
+		metrics.wall_time = time.perf_counter() - start
+		del db.sql
+
+
+def get_peak_rss_mb():
+	# ru_maxrss is reported in kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_benchmark(size, prefix=DEFAULT_PREFIX, seed=42, sample=100, keep_data=False):
+	"""Generate a dataset of `size` subscriptions and run every billing entry point on it"""
+	from isp_billing.api.gocardless import create_invoices_for_subscription
+	from isp_billing.api.sales_invoice import cleanup_paid_invoices, create_invoices_for_all_subscriptions
+	from isp_billing.api.subscription import clear_sales_invoice_ids_monthly
+
+	results = []
+
+	with measure() as metrics:
+		dataset = make_dataset(size, prefix=prefix, seed=seed)
+	results.append({"name": "generate_dataset", **dataset, **metrics.as_dict()})
+
+	# the daily run is measured serially, whatever sharding the site is configured for
+	shards = frappe.db.get_single_value("Isp Billing Setting", "billing_shards")
+	frappe.db.set_single_value("Isp Billing Setting", "billing_shards", 1)
+
+	try:
+		subscriptions = frappe.get_all(
+			"CLI Subscription",
+			filters={"name": ["like", f"{prefix}-CUST-%"]},
+			pluck="name",
+			limit=sample,
+			order_by="name desc",
+		)
+		with measure() as metrics:
+			for subscription in subscriptions:
+				create_invoices_for_subscription(subscription)
+			frappe.db.commit()
+		results.append(
+			{
+				"name": "create_invoices_for_subscription",
+				"subscriptions": len(subscriptions),
+				**metrics.as_dict(),
+			}
+		)
+
+		with measure() as metrics:
+			create_invoices_for_all_subscriptions()
+			frappe.db.commit()
+		results.append({"name": "create_invoices_for_all_subscriptions", **metrics.as_dict()})
+
+		mark_invoices_paid(prefix)
+
+		with measure() as metrics:
+			cleanup_paid_invoices()
+			frappe.db.commit()
+		results.append({"name": "cleanup_paid_invoices", **metrics.as_dict()})
+
+		with measure() as metrics:
+			clear_sales_invoice_ids_monthly()
+			frappe.db.commit()
+		results.append({"name": "clear_sales_invoice_ids_monthly", **metrics.as_dict()})
+
+	finally:
+		frappe.db.set_single_value("Isp Billing Setting", "billing_shards", shards)
+		if not keep_data:
+			delete_dataset(prefix)
+
+	return {"size": size, "seed": seed, "results": results}
+
+
+def mark_invoices_paid(prefix, share=2):
+	"""Give every `share`-th generated invoice a paid_out GoCardless status, outside the timings"""
+	SalesInvoice = DocType("Sales Invoice")
+
+	invoices = frappe.get_all(
+		"Sales Invoice",
+		filters={"customer": ["like", f"{prefix}-CUST-%"], "docstatus": 1},
+		pluck="name",
+		order_by="name",
+	)
+	for batch in create_batch(invoices[::share], 1000):
+		(
+			frappe.qb.update(SalesInvoice)
+			.set(SalesInvoice.custom_gocardless_payment_status, "paid_out")
+			.where(SalesInvoice.name.isin(batch))
+		).run()
+	frappe.db.commit()
@@ -0,0 +1,223 @@
+"""
+Synthetic billing dataset for benchmarks.
+
+Creates Items, Subscription Plans, Customers and CLI Subscriptions with a
+realistic mix of services. Masters are written with bulk inserts so a 100k
+subscription dataset takes seconds, and every generated record carries the
+dataset prefix so it can be removed again. Only run this on a scratch site.
+"""
+
+import random
+
+import frappe
+from frappe.query_builder import DocType
+from frappe.utils import add_months, getdate, now, today
+
+from isp_billing.isp_billing.doctype.subscription_service.subscription_service import (
+	get_billing_date,
+	get_period_index,
+)
+
+DEFAULT_PREFIX = "BENCH"
+
+# plan, monthly price, share of customers taking it, quantity range
+SERVICE_MIX = [
+	("Broadband 80", 35.0, 0.55, (1, 1)),
+	("Broadband 500", 55.0, 0.30, (1, 1)),
+	("Broadband 900", 75.0, 0.15, (1, 1)),
+	("Voice Line", 12.5, 0.40, (1, 4)),
+	("Static IP", 5.0, 0.15, (1, 8)),
+	("Microsoft 365", 9.6, 0.10, (1, 25)),
+]
+
+PAY_PERIODS = [
+	("Default", 0.80),
+	("3 Charge Periods", 0.12),
+	("12 Charge Periods", 0.05),
+	("Post Paid", 0.03),
+]
+STATUSES = [("Active", 0.90), ("Paused", 0.04), ("Disabled", 0.04), ("Pending", 0.02)]
+
+
+def make_dataset(subscriptions, prefix=DEFAULT_PREFIX, seed=42):
+	"""Generate `subscriptions` customers, each with one CLI Subscription"""
+	rng = random.Random(seed)
+	plans = make_plans(prefix)
+
+	customers, services = [], []
+	timestamp = now()
+	customer_group = frappe.db.get_single_value("Selling Settings", "customer_group") or "All Customer Groups"
+	territory = frappe.db.get_single_value("Selling Settings", "territory") or "All Territories"
+
+	for n in range(1, subscriptions + 1):
+		customer = f"{prefix}-CUST-{n:07d}"
+		customers.append(
+			(
+				customer,
+				customer,
+				"Individual",
+				customer_group,
+				territory,
+				f"{customer.lower()}@example.invalid",
+				f"MD{n:012d}" if rng.random() < 0.7 else None,
+				timestamp,
+				timestamp,
+				"Administrator",
+				"Administrator",
+			)
+		)
+		services.extend(make_services(rng, customer, plans, timestamp))
+
+	frappe.db.bulk_insert(
+		"Customer",
+		[
+			"name",
+			"customer_name",
+			"customer_type",
+			"customer_group",
+			"territory",
+			"custom_email",
+			"custom_gocardless_mandate_id",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+		],
+		customers,
+	)
+	frappe.db.bulk_insert(
+		"CLI Subscription",
+		["name", "customer", "creation", "modified", "owner", "modified_by"],
+		[(row[0], row[0], timestamp, timestamp, "Administrator", "Administrator") for row in customers],
+	)
+	frappe.db.bulk_insert("Subscription Service", list(SERVICE_FIELDS), services)
+	frappe.db.commit()
+
+	return {"customers": len(customers), "subscriptions": len(customers), "services": len(services)}
+
+
+SERVICE_FIELDS = (
+	"name",
+	"parent",
+	"parenttype",
+	"parentfield",
+	"idx",
+	"plan",
+	"quantity",
+	"price",
+	"pay_period",
+	"no_of_month",
+	"billing_start_date",
+	"next_billing_date",
+	"status",
+	"creation",
+	"modified",
+	"owner",
+	"modified_by",
+)
+
+
+def make_services(rng, subscription, plans, timestamp):
+	"""Service rows for one subscription: always broadband, plus optional extras"""
+	rows = []
+
+	broadband = [plan for plan in SERVICE_MIX if plan[0].startswith("Broadband")]
+	chosen = [pick(rng, [(plan, plan[2]) for plan in broadband])]
+	chosen += [plan for plan in SERVICE_MIX if not plan[0].startswith("Broadband") and rng.random() < plan[2]]
+
+	for idx, (plan_name, price, _share, quantity) in enumerate(chosen, start=1):
+		row = frappe._dict(
+			billing_start_date=add_months(getdate(today()), -rng.randint(0, 24)),
+			billing_end_date=None,
+			pay_period=pick(rng, PAY_PERIODS),
+			no_of_month=1,
+		)
+		# bill the period that contains today, so the whole dataset is due like a monthly peak
+		next_billing_date = get_billing_date(row, get_period_index(row, today()))
+
+		rows.append(
+			(
+				f"{subscription}-{idx}",
+				subscription,
+				"CLI Subscription",
+				"service",
+				idx,
+				plans[plan_name],
+				rng.randint(*quantity),
+				price,
+				row.pay_period,
+				row.no_of_month,
+				row.billing_start_date,
+				next_billing_date,
+				pick(rng, STATUSES),
+				timestamp,
+				timestamp,
+				"Administrator",
+				"Administrator",
+			)
+		)
+
+	return rows
+
+
+def make_plans(prefix):
+	"""Create (or reuse) one Item and Subscription Plan per entry of SERVICE_MIX"""
+	plans = {}
+	currency = frappe.db.get_default("currency") or "GBP"
+
+	for plan_name, price, _share, _quantity in SERVICE_MIX:
+		item_code = f"{prefix} {plan_name}"
+		if not frappe.db.exists("Item", item_code):
+			frappe.get_doc(
+				{
+					"doctype": "Item",
+					"item_code": item_code,
+					"item_name": item_code,
+					"item_group": frappe.db.get_value("Item Group", {"is_group": 0}, "name")
+					or "All Item Groups",
+					"stock_uom": "Nos",
+					"is_stock_item": 0,
+				}
+			).insert(ignore_permissions=True)
+
+		if not frappe.db.exists("Subscription Plan", item_code):
+			frappe.get_doc(
+				{
+					"doctype": "Subscription Plan",
+					"plan_name": item_code,
+					"item": item_code,
+					"price_determination": "Fixed Rate",
+					"cost": price,
+					"currency": currency,
+					"billing_interval": "Month",
+					"billing_interval_count": 1,
+				}
+			).insert(ignore_permissions=True)
+
+		plans[plan_name] = item_code
+
+	return plans
+
+
+def pick(rng, weighted):
+	"""Pick one value from a list of (value, weight) pairs"""
+	return rng.choices([value for value, _weight in weighted], weights=[w for _value, w in weighted])[0]
+
+
+def delete_dataset(prefix=DEFAULT_PREFIX):
+	"""
+	Remove the generated customers, subscriptions, service rows and billing ledger.
+	Submitted Sales Invoices are left in place; use a scratch site for benchmarks.
+	"""
+	Customer = DocType("Customer")
+	Subscription = DocType("CLI Subscription")
+	Service = DocType("Subscription Service")
+	Ledger = DocType("Subscription Billing Period")
+
+	pattern = f"{prefix}-CUST-%"
+
+	frappe.qb.from_(Ledger).delete().where(Ledger.subscription.like(pattern)).run()
+	frappe.qb.from_(Service).delete().where(Service.parent.like(pattern)).run()
+	frappe.qb.from_(Subscription).delete().where(Subscription.name.like(pattern)).run()
+	frappe.qb.from_(Customer).delete().where(Customer.name.like(pattern)).run()
+	frappe.db.commit()
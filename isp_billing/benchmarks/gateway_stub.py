@@ -0,0 +1,626 @@
+"""
+Local stand-in for the GoCardless and Stripe APIs, for load tests.
+
+Serves the subset of both APIs this app calls, GoCardless at the root and
+Stripe under /stripe, with configurable latency, error rate and a
+RateLimit-* window that answers 429 like the real APIs do. Created payments
+can be followed by signed webhooks to the site, and every exchange can be
+recorded to a JSON lines file and replayed later for a repeatable run.
+
+Point a scratch site at it through site_config.json. gocardless_pro joins
+absolute paths onto its base URL, so that URL must not have a path:
+
+	"isp_billing_gocardless_base_url": "http://127.0.0.1:8787",
+	"isp_billing_stripe_api_base": "http://127.0.0.1:8787/stripe"
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from isp_billing.benchmarks.webhooks import (
+	gocardless_payment_event,
+	post_gocardless_webhook,
+	post_stripe_webhook,
+	stripe_payment_intent_event,
+)
+
+# webhooks are batched like GoCardless does, at most this many events per request
+WEBHOOK_BATCH_SIZE = 50
+
+
+class StubConfig:
+	def __init__(
+		self,
+		latency_ms=80,
+		jitter_ms=40,
+		error_rate=0.0,
+		rate_limit=1000,
+		rate_window=60,
+		seed=42,
+		record=None,
+		replay=None,
+		site_url=None,
+		gocardless_webhook_secret=None,
+		stripe_webhook_secret=None,
+		webhook_delay=1.0,
+	):
+		self.latency_ms = latency_ms
+		self.jitter_ms = jitter_ms
+		self.error_rate = error_rate
+		self.rate_limit = rate_limit
+		self.rate_window = rate_window
+		self.seed = seed
+		self.record = record
+		self.replay = replay
+		self.site_url = site_url
+		self.gocardless_webhook_secret = gocardless_webhook_secret
+		self.stripe_webhook_secret = stripe_webhook_secret
+		self.webhook_delay = webhook_delay
+
+
+class RateLimitWindow:
+	"""Fixed window request counter, reported through the RateLimit-* headers"""
+
+	def __init__(self, limit, window):
+		self.limit = limit
+		self.window = window
+		self.lock = threading.Lock()
+		self.reset_at = time.time() + window
+		self.used = 0
+
+	def take(self):
+		"""Count one request; returns (allowed, remaining, reset_at)"""
+		with self.lock:
+			now = time.time()
+			if now >= self.reset_at:
+				self.reset_at = now + self.window
+				self.used = 0
+
+			self.used += 1
+			return self.used <= self.limit, max(self.limit - self.used, 0), self.reset_at
+
+
+class GatewayState:
+	"""In-memory GoCardless and Stripe objects created through the stub"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counter = 0
+		self.records = defaultdict(dict)
+		# GoCardless idempotency key -> payment id, Stripe idempotency key -> response
+		self.gocardless_keys = {}
+		self.stripe_keys = {}
+		self.payouts = set()
+
+	def make_id(self, prefix):
+		with self.lock:
+			self.counter += 1
+			return f"{prefix}{self.counter:010d}"
+
+	def add(self, kind, record):
+		with self.lock:
+			self.records[kind][record["id"]] = record
+		return record
+
+	def get(self, kind, record_id):
+		return self.records[kind].get(record_id)
+
+	def list(self, kind):
+		with self.lock:
+			return sorted(self.records[kind].values(), key=lambda record: record["id"])
+
+	def assign_payout(self, payout_id):
+		"""
+		The first time a payout is seen it pays out every payment that is not in
+		a payout yet; later payouts only get the payments created since.
+		"""
+		with self.lock:
+			if payout_id not in self.payouts:
+				self.payouts.add(payout_id)
+				for payment in self.records["payments"].values():
+					if not payment["links"].get("payout"):
+						payment["links"]["payout"] = payout_id
+						payment["status"] = "paid_out"
+
+			return sorted(
+				(
+					payment
+					for payment in self.records["payments"].values()
+					if payment["links"].get("payout") == payout_id
+				),
+				key=lambda payment: payment["id"],
+			)
+
+
+class WebhookDispatcher:
+	"""Sends the events raised by the stub to the site in batches, from one background thread"""
+
+	def __init__(self, config):
+		self.config = config
+		self.gocardless = deque()
+		self.stripe = deque()
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+
+	@property
+	def enabled(self):
+		return bool(self.config.site_url)
+
+	def start(self):
+		if self.enabled:
+			self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread.is_alive():
+			self.thread.join()
+
+	def run(self):
+		while not self.stopped.wait(self.config.webhook_delay):
+			self.flush()
+		self.flush()
+
+	def flush(self):
+		while self.gocardless and self.config.gocardless_webhook_secret:
+			batch = [self.gocardless.popleft() for _ in range(min(WEBHOOK_BATCH_SIZE, len(self.gocardless)))]
+			post_gocardless_webhook(self.config.site_url, batch, self.config.gocardless_webhook_secret)
+
+		while self.stripe and self.config.stripe_webhook_secret:
+			post_stripe_webhook(
+				self.config.site_url, self.stripe.popleft(), self.config.stripe_webhook_secret
+			)
+
+
+class Recorder:
+	"""Writes every exchange to a JSON lines file and replays a previous recording in order"""
+
+	def __init__(self, record=None, replay=None):
+		self.lock = threading.Lock()
+		self.file = open(record, "a") if record else None
+		self.replay = defaultdict(deque)
+
+		if replay:
+			with open(replay) as f:
+				for line in f:
+					exchange = json.loads(line)
+					self.replay[(exchange["method"], exchange["path"])].append(exchange)
+
+	def next_response(self, method, path):
+		with self.lock:
+			recorded = self.replay.get((method, path))
+			if recorded:
+				exchange = recorded.popleft()
+				return exchange["status"], exchange["response"]
+
+	def write(self, method, path, request, status, response):
+		if not self.file:
+			return
+
+		with self.lock:
+			self.file.write(
+				json.dumps(
+					{
+						"method": method,
+						"path": path,
+						"request": request,
+						"status": status,
+						"response": response,
+					}
+				)
+				+ "\n"
+			)
+			self.file.flush()
+
+	def close(self):
+		if self.file:
+			self.file.close()
+
+
+def iso_now():
+	return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def gocardless_error(status, error_type, reason, message, links=None):
+	return status, {
+		"error": {
+			"type": error_type,
+			"code": status,
+			"message": message,
+			"errors": [{"reason": reason, "message": message, "links": links or {}}],
+			"documentation_url": "https://developer.gocardless.com/api-reference",
+			"request_id": "stub",
+		}
+	}
+
+
+def stripe_error(status, error_type, message, code=None):
+	return status, {"error": {"type": error_type, "code": code, "message": message}}
+
+
+def paginate_gocardless(kind, records, query):
+	"""GoCardless cursor pagination over records sorted by id"""
+	limit = int(query.get("limit", 50))
+	after = query.get("after")
+	created_since = query.get("created_at[gte]")
+
+	if created_since:
+		records = [record for record in records if record.get("created_at", "") >= created_since]
+	if after:
+		records = [record for record in records if record["id"] > after]
+
+	page = records[:limit]
+	return 200, {
+		kind: page,
+		"meta": {
+			"cursors": {"before": None, "after": page[-1]["id"] if len(records) > limit else None},
+			"limit": limit,
+		},
+	}
+
+
+def paginate_stripe(path, records, query):
+	"""Stripe list pagination over records sorted by id"""
+	limit = int(query.get("limit", 10))
+	starting_after = query.get("starting_after")
+	if starting_after:
+		records = [record for record in records if record["id"] > starting_after]
+
+	return 200, {"object": "list", "url": path, "data": records[:limit], "has_more": len(records) > limit}
+
+
+class GatewayStub:
+	"""Routes requests to the GoCardless or Stripe emulation"""
+
+	def __init__(self, config):
+		self.config = config
+		self.rng = random.Random(config.seed)
+		self.rng_lock = threading.Lock()
+		self.state = GatewayState()
+		self.rate_limit = RateLimitWindow(config.rate_limit, config.rate_window)
+		self.webhooks = WebhookDispatcher(config)
+		self.recorder = Recorder(config.record, config.replay)
+
+		self.routes = [
+			("POST", r"/payments", self.gocardless_create_payment),
+			("GET", r"/payments/(?P<id>[^/]+)", self.gocardless_get("payments")),
+			("GET", r"/payments", self.gocardless_list("payments")),
+			("GET", r"/customers/(?P<id>[^/]+)", self.gocardless_get("customers")),
+			("GET", r"/customers", self.gocardless_list("customers")),
+			("GET", r"/mandates/(?P<id>[^/]+)", self.gocardless_get("mandates")),
+			("GET", r"/mandates", self.gocardless_list("mandates")),
+			("GET", r"/events", self.gocardless_list_events),
+			("GET", r"/payouts/(?P<id>[^/]+)", self.gocardless_get_payout),
+			("GET", r"/payout_items", self.gocardless_payout_items),
+			("POST", r"/stripe/v1/payment_intents", self.stripe_create_payment_intent),
+			("GET", r"/stripe/v1/payment_intents/(?P<id>[^/]+)", self.stripe_get("payment_intents")),
+			("POST", r"/stripe/v1/customers", self.stripe_create_customer),
+			("POST", r"/stripe/v1/customers/(?P<id>[^/]+)", self.stripe_update_customer),
+			("POST", r"/stripe/v1/payment_methods/(?P<id>[^/]+)/attach", self.stripe_attach_payment_method),
+			("GET", r"/stripe/v1/events", self.stripe_list_events),
+		]
+
+	def random(self):
+		with self.rng_lock:
+			return self.rng.random()
+
+	def handle(self, method, path, query, headers, body):
+		"""Return (status, response headers, response body) for one request"""
+		allowed, remaining, reset_at = self.rate_limit.take()
+		response_headers = {
+			"RateLimit-Limit": str(self.config.rate_limit),
+			"RateLimit-Remaining": str(remaining),
+			"RateLimit-Reset": format_datetime(datetime.fromtimestamp(reset_at, timezone.utc), usegmt=True),
+		}
+
+		latency = self.config.latency_ms + self.config.jitter_ms * self.random()
+		time.sleep(latency / 1000)
+
+		stripe = path.startswith("/stripe/")
+		if not allowed:
+			status, response = (
+				stripe_error(429, "invalid_request_error", "Too many requests", "rate_limit")
+				if stripe
+				else gocardless_error(429, "invalid_api_usage", "rate_limit_exceeded", "Rate limit exceeded")
+			)
+		elif self.random() < self.config.error_rate:
+			status, response = (
+				stripe_error(500, "api_error", "Injected server error")
+				if stripe
+				else gocardless_error(500, "gocardless", "internal_server_error", "Injected server error")
+			)
+		else:
+			status, response = self.recorder.next_response(method, path) or self.route(
+				method, path, query, headers, body
+			)
+
+		self.recorder.write(method, path, body, status, response)
+		return status, response_headers, response
+
+	def route(self, method, path, query, headers, body):
+		for route_method, pattern, handler in self.routes:
+			match = re.fullmatch(pattern, path)
+			if route_method == method and match:
+				return handler(query=query, headers=headers, body=body, **match.groupdict())
+
+		if path.startswith("/stripe/"):
+			return stripe_error(404, "invalid_request_error", f"Unrecognized request URL ({method}: {path})")
+		return gocardless_error(404, "invalid_api_usage", "path_not_found", f"Path not found: {path}")
+
+	# GoCardless
+
+	def gocardless_create_payment(self, query, headers, body):
+		params = body.get("payments") or {}
+		key = headers.get("Idempotency-Key")
+
+		if key and key in self.state.gocardless_keys:
+			return gocardless_error(
+				409,
+				"invalid_state",
+				"idempotent_creation_conflict",
+				"A resource has already been created with this idempotency key",
+				{"conflicting_resource_id": self.state.gocardless_keys[key]},
+			)
+
+		mandate_id = (params.get("links") or {}).get("mandate")
+		payment = self.state.add(
+			"payments",
+			{
+				"id": self.state.make_id("PM"),
+				"created_at": iso_now(),
+				"charge_date": (datetime.now(timezone.utc) + timedelta(days=3)).strftime("%Y-%m-%d"),
+				"amount": params.get("amount"),
+				"currency": params.get("currency"),
+				"status": "pending_submission",
+				"reference": params.get("reference"),
+				"metadata": params.get("metadata") or {},
+				"links": {"mandate": mandate_id, "creditor": "CR0000000000"},
+			},
+		)
+		if key:
+			self.state.gocardless_keys[key] = payment["id"]
+
+		self.queue_gocardless_event(payment, "created")
+		self.queue_gocardless_event(payment, "confirmed")
+		return 201, {"payments": payment}
+
+	def queue_gocardless_event(self, payment, action):
+		event = gocardless_payment_event(
+			payment["id"],
+			action,
+			invoice=payment["metadata"].get("erpnext_invoice"),
+			event_id=self.state.make_id("EV"),
+		)
+		self.state.add("events", event)
+		if self.webhooks.enabled:
+			self.webhooks.gocardless.append(event)
+
+	def gocardless_get(self, kind):
+		def get(query, headers, body, id):
+			record = self.state.get(kind, id) or self.make_gocardless_record(kind, id)
+			return 200, {kind: record}
+
+		return get
+
+	def make_gocardless_record(self, kind, record_id):
+		"""Customers and mandates the stub did not create exist anyway, like a seeded sandbox"""
+		if kind == "payments":
+			return {"id": record_id, "status": "confirmed", "metadata": {}, "links": {}}
+
+		if kind == "mandates":
+			return self.state.add(
+				"mandates",
+				{
+					"id": record_id,
+					"created_at": iso_now(),
+					"status": "active",
+					"scheme": "bacs",
+					"links": {"customer": f"CU{record_id[2:]}"},
+				},
+			)
+
+		return self.state.add(
+			"customers",
+			{
+				"id": record_id,
+				"created_at": iso_now(),
+				"email": f"{record_id.lower()}@example.com",
+				"given_name": "Stub",
+				"family_name": record_id,
+			},
+		)
+
+	def gocardless_list(self, kind):
+		def list_records(query, headers, body):
+			return paginate_gocardless(kind, self.state.list(kind), query)
+
+		return list_records
+
+	def gocardless_list_events(self, query, headers, body):
+		return paginate_gocardless("events", self.state.list("events"), query)
+
+	def gocardless_get_payout(self, query, headers, body, id):
+		self.state.assign_payout(id)
+		return 200, {
+			"payouts": {
+				"id": id,
+				"reference": f"STUB-{id}",
+				"arrival_date": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+				"currency": "GBP",
+				"status": "paid",
+			}
+		}
+
+	def gocardless_payout_items(self, query, headers, body):
+		"""The payments of the payout, less a 1% fee each"""
+		items = []
+		for payment in self.state.assign_payout(query.get("payout")):
+			items.append(
+				{
+					"id": f"PI{payment['id'][2:]}",
+					"type": "payment_paid_out",
+					"amount": str(payment["amount"]),
+					"links": {"payment": payment["id"]},
+				}
+			)
+			items.append(
+				{
+					"id": f"FE{payment['id'][2:]}",
+					"type": "gocardless_fee",
+					"amount": str(-round(int(payment["amount"] or 0) / 100)),
+					"links": {"payment": payment["id"]},
+				}
+			)
+
+		return paginate_gocardless("payout_items", items, query)
+
+	# Stripe
+
+	def stripe_idempotent(self, headers, create):
+		"""Replay the first response of a Stripe idempotency key, like Stripe does"""
+		key = headers.get("Idempotency-Key")
+		if key and key in self.state.stripe_keys:
+			return self.state.stripe_keys[key]
+
+		response = create()
+		if key:
+			self.state.stripe_keys[key] = response
+		return response
+
+	def stripe_create_payment_intent(self, query, headers, body):
+		def create():
+			confirmed = body.get("confirm") == "true"
+			payment_intent = self.state.add(
+				"payment_intents",
+				{
+					"id": self.state.make_id("pi_"),
+					"object": "payment_intent",
+					"created": int(time.time()),
+					"amount": int(body.get("amount", 0)),
+					"currency": body.get("currency"),
+					"customer": body.get("customer"),
+					"payment_method": body.get("payment_method"),
+					"client_secret": "pi_stub_secret",
+					"metadata": {
+						key[len("metadata[") : -1]: value
+						for key, value in body.items()
+						if key.startswith("metadata[")
+					},
+					"status": "succeeded" if confirmed else "requires_confirmation",
+				},
+			)
+			if confirmed:
+				self.queue_stripe_event(payment_intent, "payment_intent.succeeded")
+			return 200, payment_intent
+
+		return self.stripe_idempotent(headers, create)
+
+	def queue_stripe_event(self, payment_intent, event_type):
+		event = stripe_payment_intent_event(payment_intent, event_type, event_id=self.state.make_id("evt_"))
+		self.state.add("stripe_events", event)
+		if self.webhooks.enabled:
+			self.webhooks.stripe.append(event)
+
+	def stripe_get(self, kind):
+		def get(query, headers, body, id):
+			record = self.state.get(kind, id)
+			if not record:
+				return stripe_error(
+					404, "invalid_request_error", f"No such {kind[:-1]}: '{id}'", "resource_missing"
+				)
+			return 200, record
+
+		return get
+
+	def stripe_create_customer(self, query, headers, body):
+		def create():
+			return 200, self.state.add(
+				"stripe_customers",
+				{
+					"id": self.state.make_id("cus_"),
+					"object": "customer",
+					"created": int(time.time()),
+					"email": body.get("email"),
+					"name": body.get("name"),
+				},
+			)
+
+		return self.stripe_idempotent(headers, create)
+
+	def stripe_update_customer(self, query, headers, body, id):
+		return 200, {"id": id, "object": "customer"}
+
+	def stripe_attach_payment_method(self, query, headers, body, id):
+		return 200, {"id": id, "object": "payment_method", "customer": body.get("customer")}
+
+	def stripe_list_events(self, query, headers, body):
+		events = self.state.list("stripe_events")
+		# stripe-python sends a list as types[0]=...&types[1]=...
+		types = {value for key, value in query.items() if key == "type" or re.fullmatch(r"types\[\d*\]", key)}
+		if types:
+			events = [event for event in events if event["type"] in types]
+		if query.get("created[gte]"):
+			events = [event for event in events if event["created"] >= int(query["created[gte]"])]
+		return paginate_stripe("/v1/events", events, query)
+
+
+def make_handler(stub):
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = "HTTP/1.1"
+
+		def do_GET(self):
+			self.dispatch()
+
+		def do_POST(self):
+			self.dispatch()
+
+		def dispatch(self):
+			url = urlsplit(self.path)
+			query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+			length = int(self.headers.get("Content-Length") or 0)
+			raw = self.rfile.read(length).decode() if length else ""
+			if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+				body = {key: values[-1] for key, values in parse_qs(raw).items()}
+			else:
+				body = json.loads(raw) if raw else {}
+
+			status, headers, response = stub.handle(self.command, url.path, query, self.headers, body)
+
+			payload = json.dumps(response).encode()
+			self.send_response(status)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(payload)))
+			for header, value in headers.items():
+				self.send_header(header, value)
+			self.end_headers()
+			self.wfile.write(payload)
+
+		def log_message(self, format, *args):
+			pass
+
+	return Handler
+
+
+def serve(config, host="127.0.0.1", port=8787):
+	"""Run the stub until interrupted"""
+	stub = GatewayStub(config)
+	server = ThreadingHTTPServer((host, port), make_handler(stub))
+	server.daemon_threads = True
+
+	stub.webhooks.start()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		stub.webhooks.stop()
+		stub.recorder.close()
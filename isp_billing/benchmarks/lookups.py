@@ -0,0 +1,183 @@
+"""
+Benchmark the gateway id lookups the webhooks and sync jobs run.
+
+Grows Sales Invoice and Customer to each requested size with bare,
+cancelled rows written by bulk insert, then times single-row lookups on the
+gateway id fields and reports the index the database chose for them. With
+the fields indexed the lookup time stays flat as the tables grow; without
+an index it grows with the table. Only run this on a scratch site.
+"""
+
+import random
+import statistics
+import time
+
+import frappe
+from frappe.query_builder import DocType
+from frappe.utils import create_batch, now, today
+
+DEFAULT_PREFIX = "BENCHLK"
+
+# one generated customer per this many invoices
+INVOICES_PER_CUSTOMER = 10
+
+LOOKUP_FIELDS = [
+	("Sales Invoice", "custom_gocardless_payment_id"),
+	("Sales Invoice", "custom_stripe_payment_id"),
+	("Customer", "custom_gocardless_mandate_id"),
+	("Customer", "custom_stripe_customer_id"),
+]
+
+
+def get_gateway_ids(prefix, n):
+	return {
+		"custom_gocardless_payment_id": f"PM{prefix}{n:010d}",
+		"custom_stripe_payment_id": f"pi_{prefix.lower()}{n:012d}",
+		"custom_gocardless_mandate_id": f"MD{prefix}{n:010d}",
+		"custom_stripe_customer_id": f"cus_{prefix.lower()}{n:012d}",
+	}
+
+
+def grow_tables(prefix, start, end):
+	"""Insert invoices start+1..end and their customers, as cancelled bare rows"""
+	timestamp = now()
+	posting_date = today()
+	customer_group = frappe.db.get_single_value("Selling Settings", "customer_group") or "All Customer Groups"
+	territory = frappe.db.get_single_value("Selling Settings", "territory") or "All Territories"
+
+	for batch in create_batch(range(start + 1, end + 1), 10000):
+		frappe.db.bulk_insert(
+			"Sales Invoice",
+			[
+				"name",
+				"customer",
+				"posting_date",
+				"docstatus",
+				"custom_gocardless_payment_id",
+				"custom_stripe_payment_id",
+				"creation",
+				"modified",
+				"owner",
+				"modified_by",
+			],
+			[
+				(
+					f"{prefix}-SINV-{n:09d}",
+					f"{prefix}-CUST-{n // INVOICES_PER_CUSTOMER:08d}",
+					posting_date,
+					2,
+					get_gateway_ids(prefix, n)["custom_gocardless_payment_id"],
+					get_gateway_ids(prefix, n)["custom_stripe_payment_id"],
+					timestamp,
+					timestamp,
+					"Administrator",
+					"Administrator",
+				)
+				for n in batch
+			],
+		)
+
+		customers = [n // INVOICES_PER_CUSTOMER for n in batch if n % INVOICES_PER_CUSTOMER == 0]
+		frappe.db.bulk_insert(
+			"Customer",
+			[
+				"name",
+				"customer_name",
+				"customer_type",
+				"customer_group",
+				"territory",
+				"disabled",
+				"custom_gocardless_mandate_id",
+				"custom_stripe_customer_id",
+				"creation",
+				"modified",
+				"owner",
+				"modified_by",
+			],
+			[
+				(
+					f"{prefix}-CUST-{c:08d}",
+					f"{prefix}-CUST-{c:08d}",
+					"Individual",
+					customer_group,
+					territory,
+					1,
+					get_gateway_ids(prefix, c)["custom_gocardless_mandate_id"],
+					get_gateway_ids(prefix, c)["custom_stripe_customer_id"],
+					timestamp,
+					timestamp,
+					"Administrator",
+					"Administrator",
+				)
+				for c in customers
+			],
+		)
+		frappe.db.commit()
+
+
+def get_index_used(doctype, fieldname, value):
+	"""Index MariaDB picks for an equality lookup on the field, None for a full scan"""
+	if frappe.db.db_type != "mariadb":
+		return "n/a"
+
+	plan = frappe.db.sql(
+		f"EXPLAIN SELECT `name` FROM `tab{doctype}` WHERE `{fieldname}` = %s",
+		value,
+		as_dict=True,
+	)
+	return plan[0].get("key")
+
+
+def time_lookups(prefix, rows, lookups, rng):
+	results = []
+	customers = rows // INVOICES_PER_CUSTOMER
+
+	for doctype, fieldname in LOOKUP_FIELDS:
+		population = max(rows if doctype == "Sales Invoice" else customers, 1)
+		values = [get_gateway_ids(prefix, rng.randint(1, population))[fieldname] for _ in range(lookups)]
+
+		timings = []
+		for value in values:
+			start = time.perf_counter()
+			frappe.db.get_value(doctype, {fieldname: value}, "name")
+			timings.append((time.perf_counter() - start) * 1000)
+
+		results.append(
+			{
+				"doctype": doctype,
+				"field": fieldname,
+				"table_rows": population,
+				"index": get_index_used(doctype, fieldname, values[0]),
+				"median_ms": round(statistics.median(timings), 3),
+				"p95_ms": round(sorted(timings)[int(len(timings) * 0.95) - 1], 3),
+			}
+		)
+
+	return results
+
+
+def run_lookup_benchmark(sizes, prefix=DEFAULT_PREFIX, lookups=200, seed=42, keep_data=False):
+	"""Grow the tables through each of `sizes` generated invoices and time the lookups at every step"""
+	rng = random.Random(seed)
+	runs = []
+	rows = 0
+
+	try:
+		for size in sorted(sizes):
+			grow_tables(prefix, rows, size)
+			rows = size
+			runs.append({"invoices": rows, "lookups": time_lookups(prefix, rows, lookups, rng)})
+	finally:
+		if not keep_data:
+			delete_lookup_data(prefix)
+
+	return {"seed": seed, "lookups_per_field": lookups, "runs": runs}
+
+
+def delete_lookup_data(prefix=DEFAULT_PREFIX):
+	SalesInvoice = DocType("Sales Invoice")
+	Customer = DocType("Customer")
+
+	frappe.qb.from_(SalesInvoice).delete().where(SalesInvoice.name.like(f"{prefix}-SINV-%")).run()
+	frappe.qb.from_(Customer).delete().where(Customer.name.like(f"{prefix}-CUST-%")).run()
+	frappe.db.commit()
@@ -0,0 +1,43 @@
+import threading
+import unittest
+from http.server import ThreadingHTTPServer
+
+import gocardless_pro
+
+from isp_billing.benchmarks.gateway_stub import GatewayStub, StubConfig, make_handler
+
+
+class TestGatewayStub(unittest.TestCase):
+	"""Smoke test: the real gocardless_pro client, pointed at the stub like a scratch site would be"""
+
+	def setUp(self):
+		self.stub = GatewayStub(StubConfig(latency_ms=0, jitter_ms=0))
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(self.stub))
+		self.server.daemon_threads = True
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+		host, port = self.server.server_address
+		self.client = gocardless_pro.Client(access_token="stub", base_url=f"http://{host}:{port}")
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_gocardless_client(self):
+		payment = self.client.payments.create(
+			params={
+				"amount": 1000,
+				"currency": "GBP",
+				"links": {"mandate": "MD0000000001"},
+				"metadata": {"erpnext_invoice": "ACC-SINV-0001"},
+			},
+			headers={"Idempotency-Key": "stub-smoke-test"},
+		)
+
+		self.assertEqual(self.client.payments.get(payment.id).status, "pending_submission")
+		self.assertEqual([record.id for record in self.client.payments.list().records], [payment.id])
+		self.assertEqual(self.client.mandates.get("MD0000000001").status, "active")
+
+		payout = self.client.payouts.get("PO0000000001")
+		items = self.client.payout_items.list(params={"payout": payout.id}).records
+		self.assertEqual({item.links.payment for item in items}, {payment.id})
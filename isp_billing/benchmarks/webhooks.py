@@ -0,0 +1,131 @@
+"""
+Signed GoCardless and Stripe webhooks for load tests.
+
+Payloads are signed exactly the way the site verifies them: GoCardless with
+a hex HMAC-SHA256 of the body in Webhook-Signature, Stripe with the
+"t=<timestamp>,v1=<HMAC-SHA256 of timestamp.body>" Stripe-Signature header.
+"""
+
+import hashlib
+import hmac
+import json
+import time
+from datetime import datetime, timezone
+
+import requests
+
+GOCARDLESS_WEBHOOK_PATH = "/api/method/isp_billing.api.gocardless.gocardless_webhook"
+STRIPE_WEBHOOK_PATH = "/api/method/isp_billing.api.stripe.stripe_webhook"
+
+WEBHOOK_TIMEOUT = (5, 60)
+
+# PaymentIntent status carried by each Stripe event type
+STRIPE_EVENT_STATUSES = {
+	"payment_intent.succeeded": "succeeded",
+	"payment_intent.processing": "processing",
+	"payment_intent.payment_failed": "requires_payment_method",
+	"payment_intent.canceled": "canceled",
+}
+
+
+def sign_gocardless(payload, secret):
+	return hmac.new(secret.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def sign_stripe(payload, secret, timestamp=None):
+	timestamp = int(timestamp or time.time())
+	signature = hmac.new(
+		secret.encode("utf-8"), f"{timestamp}.{payload}".encode(), hashlib.sha256
+	).hexdigest()
+	return f"t={timestamp},v1={signature}"
+
+
+def gocardless_payment_event(payment_id, action, invoice=None, event_id=None):
+	"""A GoCardless payments event, with the invoice metadata the app puts on its payments"""
+	created_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+	digest = hashlib.md5(f"{payment_id}-{action}".encode()).hexdigest()
+	return {
+		"id": event_id or f"EV{digest[:12].upper()}",
+		"created_at": created_at,
+		"resource_type": "payments",
+		"action": action,
+		"links": {"payment": payment_id},
+		"details": {"origin": "gocardless", "cause": f"payment_{action}", "description": "Load test event"},
+		"resource_metadata": {"erpnext_invoice": invoice} if invoice else {},
+		"metadata": {},
+	}
+
+
+def stripe_payment_intent_event(payment_intent, event_type, event_id=None):
+	"""A Stripe payment_intent.* event wrapping the given PaymentIntent dict"""
+	digest = hashlib.md5(f"{payment_intent['id']}-{event_type}".encode()).hexdigest()
+	return {
+		"id": event_id or f"evt_{digest[:24]}",
+		"object": "event",
+		"api_version": "2024-06-20",
+		"created": int(time.time()),
+		"type": event_type,
+		"livemode": False,
+		"pending_webhooks": 1,
+		"data": {"object": payment_intent},
+	}
+
+
+def post_gocardless_webhook(site_url, events, secret, session=None):
+	payload = json.dumps({"events": events})
+	return (session or requests).post(
+		site_url.rstrip("/") + GOCARDLESS_WEBHOOK_PATH,
+		data=payload,
+		headers={"Content-Type": "application/json", "Webhook-Signature": sign_gocardless(payload, secret)},
+		timeout=WEBHOOK_TIMEOUT,
+	)
+
+
+def post_stripe_webhook(site_url, event, secret, session=None):
+	payload = json.dumps(event)
+	return (session or requests).post(
+		site_url.rstrip("/") + STRIPE_WEBHOOK_PATH,
+		data=payload,
+		headers={"Content-Type": "application/json", "Stripe-Signature": sign_stripe(payload, secret)},
+		timeout=WEBHOOK_TIMEOUT,
+	)
+
+
+def send_webhook_load(site_url, gateway, payments, secret, action, batch_size=50):
+	"""
+	Post one event per (payment id, invoice) pair to the site and time it.
+	GoCardless events go out in batches of `batch_size` per request like
+	GoCardless sends them, Stripe events one per request.
+	"""
+	session = requests.Session()
+	statuses = {}
+	start = time.perf_counter()
+
+	if gateway == "GoCardless":
+		events = [gocardless_payment_event(payment_id, action, invoice) for payment_id, invoice in payments]
+		for i in range(0, len(events), batch_size):
+			response = post_gocardless_webhook(site_url, events[i : i + batch_size], secret, session)
+			statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+	else:
+		for payment_id, invoice in payments:
+			payment_intent = {
+				"id": payment_id,
+				"object": "payment_intent",
+				"status": STRIPE_EVENT_STATUSES[action],
+			}
+			if invoice:
+				payment_intent["metadata"] = {"erpnext_invoice": invoice}
+			response = post_stripe_webhook(
+				site_url, stripe_payment_intent_event(payment_intent, action), secret, session
+			)
+			statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+	wall_time = time.perf_counter() - start
+	return {
+		"gateway": gateway,
+		"events": len(payments),
+		"requests": sum(statuses.values()),
+		"status_codes": statuses,
+		"wall_time_s": round(wall_time, 3),
+		"events_per_s": round(len(payments) / wall_time, 1) if wall_time else None,
+	}
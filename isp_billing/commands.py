@@ -0,0 +1,169 @@
+import json
+
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+import isp_billing
+from isp_billing.benchmarks.dataset import DEFAULT_PREFIX
+
+
+@click.command("isp-billing-generate-dataset")
+@click.option("--subscriptions", default=1000, type=int, help="Number of customers / CLI Subscriptions")
+@click.option("--prefix", default=DEFAULT_PREFIX, help="Name prefix of the generated records")
+@click.option("--seed", default=42, type=int)
+@click.option("--delete", is_flag=True, default=False, help="Remove a previously generated dataset instead")
+@pass_context
+def generate_dataset(context, subscriptions, prefix, seed, delete):
+	"Generate (or delete) a synthetic billing dataset on a scratch site"
+	from isp_billing.benchmarks.dataset import delete_dataset, make_dataset
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		if delete:
+			delete_dataset(prefix)
+		else:
+			click.echo(json.dumps(make_dataset(subscriptions, prefix=prefix, seed=seed)))
+	finally:
+		frappe.destroy()
+
+
+@click.command("isp-billing-benchmark")
+@click.option(
+	"--size", "sizes", multiple=True, type=int, help="Subscriptions to generate, repeatable (default 1000)"
+)
+@click.option("--prefix", default=DEFAULT_PREFIX, help="Name prefix of the generated records")
+@click.option("--seed", default=42, type=int)
+@click.option(
+	"--sample", default=100, type=int, help="Subscriptions billed one by one through the form button"
+)
+@click.option("--keep-data", is_flag=True, default=False, help="Keep the generated dataset afterwards")
+@click.option("--output", type=click.Path(dir_okay=False), help="Also write the JSON report to this file")
+@pass_context
+def benchmark(context, sizes, prefix, seed, sample, keep_data, output):
+	"Run the billing entry points against generated datasets and report timings as JSON"
+	from isp_billing.benchmarks.billing import run_benchmark
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		report = {
+			"site": frappe.local.site,
+			"app_version": isp_billing.__version__,
+			"runs": [
+				run_benchmark(size, prefix=prefix, seed=seed, sample=sample, keep_data=keep_data)
+				for size in sizes or (1000,)
+			],
+		}
+	finally:
+		frappe.destroy()
+
+	report = json.dumps(report, indent=1, default=str)
+	if output:
+		with open(output, "w") as f:
+			f.write(report)
+	click.echo(report)
+
+
+@click.command("isp-billing-gateway-stub")
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8787, type=int)
+@click.option("--latency-ms", default=80, type=float, help="Base latency of every response")
+@click.option("--jitter-ms", default=40, type=float, help="Random extra latency, up to this much")
+@click.option("--error-rate", default=0.0, type=float, help="Share of requests answered with a 500")
+@click.option("--rate-limit", default=1000, type=int, help="Requests allowed per rate limit window")
+@click.option("--rate-window", default=60, type=int, help="Length of the rate limit window in seconds")
+@click.option("--seed", default=42, type=int)
+@click.option(
+	"--record", type=click.Path(dir_okay=False), help="Append every exchange to this JSON lines file"
+)
+@click.option(
+	"--replay", type=click.Path(exists=True, dir_okay=False), help="Serve the responses of a recording"
+)
+@click.option("--site-url", help="Send webhooks for created payments to this site")
+@click.option("--gocardless-webhook-secret", help="Sign GoCardless webhooks with this secret")
+@click.option("--stripe-webhook-secret", help="Sign Stripe webhooks with this secret")
+def gateway_stub(host, port, **options):
+	"Serve a local GoCardless and Stripe API stub for offline load tests"
+	from isp_billing.benchmarks.gateway_stub import StubConfig, serve
+
+	click.echo(f"GoCardless base URL: http://{host}:{port}")
+	click.echo(f"Stripe API base: http://{host}:{port}/stripe")
+	serve(StubConfig(**options), host=host, port=port)
+
+
+@click.command("isp-billing-send-webhooks")
+@click.option("--gateway", type=click.Choice(["GoCardless", "Stripe"]), default="GoCardless")
+@click.option(
+	"--action", help="GoCardless action or Stripe event type (default confirmed / payment_intent.succeeded)"
+)
+@click.option("--limit", default=1000, type=int, help="Invoices with a payment id to send events for")
+@click.option("--batch-size", default=50, type=int, help="GoCardless events per webhook request")
+@click.option("--site-url", help="Defaults to the site's own URL")
+@pass_context
+def send_webhooks(context, gateway, action, limit, batch_size, site_url):
+	"Send signed payment webhooks for existing invoices to the site and report the throughput"
+	from frappe.utils import get_url
+
+	from isp_billing.benchmarks.webhooks import send_webhook_load
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		payment_field = (
+			"custom_gocardless_payment_id" if gateway == "GoCardless" else "custom_stripe_payment_id"
+		)
+		payments = frappe.get_all(
+			"Sales Invoice",
+			filters={payment_field: ["is", "set"], "docstatus": 1},
+			fields=[payment_field, "name"],
+			as_list=True,
+			limit=limit,
+		)
+		settings = frappe.get_single("Isp Billing Setting")
+		secret = settings.webhook_secret if gateway == "GoCardless" else settings.get("stripe_webhook_secret")
+		site_url = site_url or get_url()
+	finally:
+		frappe.destroy()
+
+	if not secret:
+		raise click.ClickException(f"No {gateway} webhook secret is set in Isp Billing Setting")
+
+	action = action or ("confirmed" if gateway == "GoCardless" else "payment_intent.succeeded")
+	report = send_webhook_load(site_url, gateway, payments, secret, action, batch_size=batch_size)
+	click.echo(json.dumps(report, indent=1))
+
+
+@click.command("isp-billing-benchmark-lookups")
+@click.option("--rows", "sizes", multiple=True, type=int, help="Generated invoices per step, repeatable")
+@click.option("--lookups", default=200, type=int, help="Lookups timed per field and step")
+@click.option("--seed", default=42, type=int)
+@click.option("--keep-data", is_flag=True, default=False, help="Keep the generated rows afterwards")
+@click.option("--output", type=click.Path(dir_okay=False), help="Also write the JSON report to this file")
+@pass_context
+def benchmark_lookups(context, sizes, lookups, seed, keep_data, output):
+	"Time gateway id lookups on Sales Invoice and Customer as the tables grow"
+	from isp_billing.benchmarks.lookups import run_lookup_benchmark
+
+	frappe.init(site=get_site(context))
+	frappe.connect()
+	try:
+		report = {
+			"site": frappe.local.site,
+			"app_version": isp_billing.__version__,
+			**run_lookup_benchmark(
+				sizes or (10000, 100000, 500000), lookups=lookups, seed=seed, keep_data=keep_data
+			),
+		}
+	finally:
+		frappe.destroy()
+
+	report = json.dumps(report, indent=1, default=str)
+	if output:
+		with open(output, "w") as f:
+			f.write(report)
+	click.echo(report)
+
+
+commands = [generate_dataset, benchmark, gateway_stub, send_webhooks, benchmark_lookups]
@@ -177,6 +177,7 @@ fixtures = [
 
 doc_events = {
     "Customer": {
+        "validate": "isp_billing.api.customer.set_email_key",
         "after_insert": "isp_billing.api.customer.create_portal_user"
     },
     "Issue": {
@@ -203,11 +204,16 @@ doc_events = {
 
 
 scheduler_events = {
+    "hourly": [
+        "isp_billing.api.gocardless.process_gocardless_webhook_events",
+        "isp_billing.api.stripe.process_stripe_webhook_events"
+    ],
+    "hourly_long": [
+        "isp_billing.api.gocardless_sync.sync_gocardless",
+        "isp_billing.api.stripe_sync.sync_stripe_payment_events"
+    ],
     "daily": [
         "isp_billing.api.sales_invoice.create_invoices_for_all_subscriptions"
-    ],
-    "monthly": [
-        "isp_billing.api.subscription.clear_sales_invoice_ids_monthly"
     ]
 }
 
@@ -0,0 +1,153 @@
+# Copyright (c) 2026, MSS and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder import DocType
+from frappe.utils import now_datetime, today
+
+
+class BillingRun(Document):
+	pass
+
+
+def get_billing_run(run_type, shard_count=1, subscriptions=None):
+	"""
+	Return today's unfinished run of the same kind so it can be resumed from its
+	checkpoints, or start a new one with one shard row per partition.
+	"""
+	selection = "\n".join(subscriptions) if subscriptions else None
+
+	filters = {
+		"run_type": run_type,
+		"posting_date": today(),
+		"status": ["!=", "Completed"],
+		"shard_count": shard_count,
+		"subscriptions": selection or ["is", "not set"],
+	}
+	name = frappe.db.get_value("Billing Run", filters, "name", order_by="creation desc")
+
+	if name:
+		frappe.db.set_value("Billing Run", name, {"status": "Running", "ended_on": None})
+		return frappe.get_doc("Billing Run", name)
+
+	run = frappe.get_doc(
+		{
+			"doctype": "Billing Run",
+			"run_type": run_type,
+			"status": "Running",
+			"posting_date": today(),
+			"started_on": now_datetime(),
+			"shard_count": shard_count,
+			"subscriptions": selection,
+			"shards": [{"shard": shard, "status": "Pending"} for shard in range(shard_count)],
+		}
+	)
+	run.insert(ignore_permissions=True)
+	frappe.db.commit()
+	return run
+
+
+def start_shard(billing_run, shard):
+	"""Mark a shard as running and return the customer it last committed"""
+	Shard = DocType("Billing Run Shard")
+
+	row = frappe.db.get_value(
+		"Billing Run Shard",
+		{"parent": billing_run, "parenttype": "Billing Run", "shard": shard},
+		["name", "started_on", "last_customer"],
+		as_dict=True,
+	)
+
+	(
+		frappe.qb.update(Shard)
+		.set(Shard.status, "Running")
+		.set(Shard.started_on, row.started_on or now_datetime())
+		.set(Shard.ended_on, None)
+		.where(Shard.name == row.name)
+	).run()
+	frappe.db.commit()
+
+	return row.last_customer
+
+
+def record_checkpoint(billing_run, shard, customer, invoices_created=0, advance=True):
+	"""
+	Count `customer` as processed and, with `advance`, move the checkpoint of
+	the shard past it. Counters are bumped in SQL so shards running in parallel
+	never overwrite each other's progress.
+	"""
+	Run = DocType("Billing Run")
+	Shard = DocType("Billing Run Shard")
+
+	shard_update = (
+		frappe.qb.update(Shard)
+		.set(Shard.customers_processed, Shard.customers_processed + 1)
+		.set(Shard.invoices_created, Shard.invoices_created + invoices_created)
+		.where(Shard.parent == billing_run)
+		.where(Shard.parenttype == "Billing Run")
+		.where(Shard.shard == shard)
+	)
+	run_update = (
+		frappe.qb.update(Run)
+		.set(Run.customers_processed, Run.customers_processed + 1)
+		.set(Run.invoices_created, Run.invoices_created + invoices_created)
+		.where(Run.name == billing_run)
+	)
+
+	if advance:
+		shard_update = shard_update.set(Shard.last_customer, customer)
+		run_update = run_update.set(Run.last_customer, customer)
+
+	shard_update.run()
+	run_update.run()
+
+
+def record_error(billing_run, shard, customer, error):
+	"""Append a per-customer error to the run without re-saving the whole document"""
+	Run = DocType("Billing Run")
+
+	frappe.get_doc(
+		{
+			"doctype": "Billing Run Error",
+			"parent": billing_run,
+			"parenttype": "Billing Run",
+			"parentfield": "errors",
+			"idx": frappe.db.count("Billing Run Error", {"parent": billing_run}) + 1,
+			"customer": customer,
+			"shard": shard,
+			"error": error,
+		}
+	).db_insert()
+
+	(frappe.qb.update(Run).set(Run.errors_count, Run.errors_count + 1).where(Run.name == billing_run)).run()
+
+
+def finish_shard(billing_run, shard, status="Completed"):
+	"""Close a shard and, once no shard is left open, close the run itself"""
+	Shard = DocType("Billing Run Shard")
+
+	(
+		frappe.qb.update(Shard)
+		.set(Shard.status, status)
+		.set(Shard.ended_on, now_datetime())
+		.where(Shard.parent == billing_run)
+		.where(Shard.parenttype == "Billing Run")
+		.where(Shard.shard == shard)
+	).run()
+
+	# lock the run so two shards finishing together agree on who closes it
+	frappe.db.get_value("Billing Run", billing_run, "name", for_update=True)
+
+	statuses = frappe.get_all("Billing Run Shard", filters={"parent": billing_run}, pluck="status")
+	if any(s in ("Pending", "Running") for s in statuses):
+		return
+
+	frappe.db.set_value(
+		"Billing Run",
+		billing_run,
+		{
+			"status": "Failed" if "Failed" in statuses else "Completed",
+			"ended_on": now_datetime(),
+		},
+	)
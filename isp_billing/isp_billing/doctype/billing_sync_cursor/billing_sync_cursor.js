@@ -0,0 +1,8 @@
+// Copyright (c) 2026, MSS and contributors
+// For license information, please see license.txt
+
+// frappe.ui.form.on("Billing Sync Cursor", {
+// 	refresh(frm) {
+
+// 	},
+// });
@@ -0,0 +1,31 @@
+# Copyright (c) 2026, MSS and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.utils import now_datetime
+
+
+class BillingSyncCursor(Document):
+	pass
+
+
+def get_sync_cursor(gateway, resource):
+	"""Checkpoint of the last sync of one gateway resource, or None before the first sync"""
+	return frappe.db.get_value("Billing Sync Cursor", f"{gateway}-{resource}", "cursor")
+
+
+def set_sync_cursor(gateway, resource, cursor, records=0):
+	"""Move the checkpoint of a gateway resource forward after a completed sync"""
+	name = f"{gateway}-{resource}"
+
+	if not frappe.db.exists("Billing Sync Cursor", name):
+		frappe.get_doc({"doctype": "Billing Sync Cursor", "gateway": gateway, "resource": resource}).insert(
+			ignore_permissions=True
+		)
+
+	frappe.db.set_value(
+		"Billing Sync Cursor",
+		name,
+		{"cursor": cursor, "last_synced_on": now_datetime(), "records_synced": records},
+	)
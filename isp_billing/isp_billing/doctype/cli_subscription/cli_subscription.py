@@ -4,6 +4,56 @@
 # import frappe
 from frappe.model.document import Document
 
+from isp_billing.isp_billing.doctype.subscription_billing_period.subscription_billing_period import (
+	get_billed_periods,
+)
+from isp_billing.isp_billing.doctype.subscription_service.subscription_service import (
+	get_billing_date,
+	get_billing_period_start,
+	get_catch_up_billing_date,
+	get_next_billing_date,
+	get_period_index,
+	skip_billed_periods,
+)
+
+SCHEDULE_FIELDS = ("billing_start_date", "billing_end_date", "pay_period", "no_of_month")
+
 
 class CLISubscription(Document):
-	pass
+	def validate(self):
+		self.set_next_billing_dates()
+
+	def set_next_billing_dates(self):
+		"""
+		Schedule new service rows and move edited ones onto their new billing
+		terms. New rows and rows that become Active again start on the current
+		period instead of back-billing the ones that went by.
+		"""
+		before = self.get_doc_before_save()
+		previous = {row.name: row for row in before.service} if before else {}
+
+		for row in self.service:
+			if not row.billing_start_date:
+				continue
+
+			old = previous.get(row.name)
+			if not row.next_billing_date or not old or not old.next_billing_date:
+				row.next_billing_date = row.next_billing_date or get_catch_up_billing_date(
+					row, get_next_billing_date(row)
+				)
+				continue
+
+			reactivated = row.status == "Active" and old.status != "Active"
+			edited = any(str(row.get(field) or "") != str(old.get(field) or "") for field in SCHEDULE_FIELDS)
+			if not (reactivated or edited):
+				continue
+
+			# stay at the period that was due next instead of starting the schedule over
+			next_billing_date = get_billing_date(
+				row, get_period_index(row, get_billing_period_start(old, old.next_billing_date))
+			)
+			if reactivated:
+				next_billing_date = get_catch_up_billing_date(row, next_billing_date)
+
+			# never on a period that has already been billed
+			row.next_billing_date = skip_billed_periods(row, next_billing_date, get_billed_periods(row.name))
@@ -1,9 +1,87 @@
 # Copyright (c) 2025, MSS and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_months, getdate, today
+
+from isp_billing.isp_billing.doctype.subscription_service.subscription_service import (
+	get_billing_date,
+	get_period_index,
+)
+
+
+def make_subscription(**service):
+	return frappe.get_doc(
+		{
+			"doctype": "CLI Subscription",
+			"service": [
+				{
+					"name": "test-service-row",
+					"billing_start_date": "2026-01-01",
+					"pay_period": "Default",
+					"no_of_month": 1,
+					"status": "Active",
+					**service,
+				}
+			],
+		}
+	)
+
+
+def get_current_billing_date(row):
+	return get_billing_date(row, get_period_index(row, today()))
 
 
 class TestCLISubscription(FrappeTestCase):
-	pass
+	def save_schedule(self, doc, before=None, billed=()):
+		with (
+			patch.object(doc, "get_doc_before_save", return_value=before),
+			patch(
+				"isp_billing.isp_billing.doctype.cli_subscription.cli_subscription.get_billed_periods",
+				return_value=list(billed),
+			),
+		):
+			doc.set_next_billing_dates()
+
+		return getdate(doc.service[0].next_billing_date)
+
+	def test_new_row_starts_on_current_period(self):
+		# entered with a start date two years back: bill the current period, not all 24
+		doc = make_subscription(billing_start_date=add_months(today(), -24))
+
+		self.assertEqual(self.save_schedule(doc), get_current_billing_date(doc.service[0]))
+
+	def test_new_row_starting_later(self):
+		start = add_months(today(), 2)
+		doc = make_subscription(billing_start_date=start)
+
+		self.assertEqual(self.save_schedule(doc), getdate(start))
+
+	def test_reactivated_row_skips_paused_periods(self):
+		start = add_months(today(), -12)
+		paused_at = add_months(start, 5)
+		before = make_subscription(billing_start_date=start, next_billing_date=paused_at, status="Paused")
+		doc = make_subscription(billing_start_date=start, next_billing_date=paused_at)
+
+		self.assertEqual(self.save_schedule(doc, before), get_current_billing_date(doc.service[0]))
+
+	def test_post_paid_edit_keeps_due_period(self):
+		# the January period is due on 1 February; a new end date must not skip it
+		before = make_subscription(pay_period="Post Paid", next_billing_date="2026-02-01")
+		doc = make_subscription(
+			pay_period="Post Paid", next_billing_date="2026-02-01", billing_end_date="2026-12-31"
+		)
+
+		self.assertEqual(self.save_schedule(doc, before), getdate("2026-02-01"))
+
+	def test_schedule_edit_skips_billed_period(self):
+		# January is billed monthly, then the row is moved to quarterly billing
+		before = make_subscription(next_billing_date="2026-02-01")
+		doc = make_subscription(next_billing_date="2026-02-01", pay_period="3 Charge Periods")
+		billed = [(getdate("2026-01-01"), getdate("2026-01-01"))]
+
+		# the quarter that contains January is already billed, so the row moves on to April
+		self.assertEqual(self.save_schedule(doc, before, billed), getdate("2026-04-01"))
@@ -4,6 +4,28 @@
 # import frappe
 from frappe.model.document import Document
 
+# mandate statuses that can never be charged again
+DEAD_MANDATE_STATUSES = ("cancelled", "failed", "expired", "consumed", "blocked")
+
+# mandate statuses that cannot be charged for now, but come back to active
+# once the payer reinstates the mandate
+SUSPENDED_MANDATE_STATUSES = ("suspended_by_payer",)
+
+# mandate status after each mandate event action; other actions are looked up
+MANDATE_ACTION_STATUSES = {
+	"customer_approval_granted": "pending_submission",
+	"submitted": "submitted",
+	"active": "active",
+	"reinstated": "active",
+	"resubmission_requested": "pending_submission",
+	"cancelled": "cancelled",
+	"failed": "failed",
+	"expired": "expired",
+	"consumed": "consumed",
+	"blocked": "blocked",
+	"suspended_by_payer": "suspended_by_payer",
+}
+
 
 class GoCardlessMandates(Document):
 	pass
@@ -0,0 +1,123 @@
+# Copyright (c) 2026, MSS and contributors
+# For license information, please see license.txt
+
+import json
+from datetime import datetime
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder import DocType
+from frappe.query_builder.functions import Max
+from frappe.utils import now_datetime
+
+
+class GoCardlessWebhookEvent(Document):
+	pass
+
+
+def get_event_resource_id(event):
+	"""ID of the resource an event is about, e.g. links.payment for a payments event"""
+	links = event.get("links") or {}
+	return links.get((event.get("resource_type") or "").rstrip("s"))
+
+
+def get_event_created_at(event):
+	created_at = event.get("created_at")
+	if not created_at:
+		return None
+	return datetime.fromisoformat(created_at.replace("Z", "+00:00")).replace(tzinfo=None)
+
+
+def insert_webhook_events(events):
+	"""
+	Store the raw events of one webhook delivery in a single INSERT. Events that
+	are already stored (GoCardless redeliveries) are skipped by the primary key.
+	"""
+	now = now_datetime()
+	user = frappe.session.user
+
+	values = [
+		(
+			event["id"],
+			event["id"],
+			event.get("resource_type"),
+			event.get("action"),
+			get_event_resource_id(event),
+			"Pending",
+			get_event_created_at(event),
+			now,
+			json.dumps(event),
+			now,
+			now,
+			user,
+			user,
+		)
+		for event in events
+		if event.get("id")
+	]
+
+	frappe.db.bulk_insert(
+		"GoCardless Webhook Event",
+		[
+			"name",
+			"event_id",
+			"resource_type",
+			"action",
+			"resource_id",
+			"status",
+			"event_created_at",
+			"received_on",
+			"payload",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+		],
+		values,
+		ignore_duplicates=True,
+	)
+
+	return len(values)
+
+
+def get_pending_events(limit=500):
+	"""Oldest pending events first, so state changes are applied in the order they happened"""
+	return frappe.get_all(
+		"GoCardless Webhook Event",
+		filters={"status": "Pending"},
+		fields=["name", "resource_type", "action", "resource_id", "event_created_at", "payload"],
+		order_by="event_created_at asc, name asc",
+		limit=limit,
+	)
+
+
+def get_last_applied(resource_ids):
+	"""created_at of the newest processed event per GoCardless resource"""
+	if not resource_ids:
+		return {}
+
+	Event = DocType("GoCardless Webhook Event")
+	return dict(
+		(
+			frappe.qb.from_(Event)
+			.select(Event.resource_id, Max(Event.event_created_at))
+			.where(Event.resource_id.isin(list(resource_ids)))
+			.where(Event.status == "Processed")
+			.groupby(Event.resource_id)
+		).run()
+	)
+
+
+def set_event_status(events, status, error=None):
+	"""Mark a set of events as processed or failed in one UPDATE"""
+	if not events:
+		return
+
+	Event = DocType("GoCardless Webhook Event")
+	(
+		frappe.qb.update(Event)
+		.set(Event.status, status)
+		.set(Event.processed_on, now_datetime())
+		.set(Event.error, error)
+		.where(Event.name.isin(events))
+	).run()
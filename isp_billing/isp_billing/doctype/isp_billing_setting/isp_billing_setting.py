@@ -6,4 +6,9 @@ from frappe.model.document import Document
 
 
 class IspBillingSetting(Document):
-	pass
+	def on_update(self):
+		from isp_billing.api.gocardless import clear_gocardless_client
+		from isp_billing.api.stripe import clear_stripe_client
+
+		clear_gocardless_client()
+		clear_stripe_client()
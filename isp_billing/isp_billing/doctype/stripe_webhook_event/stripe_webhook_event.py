@@ -0,0 +1,115 @@
+# Copyright (c) 2026, MSS and contributors
+# For license information, please see license.txt
+
+import json
+from datetime import datetime, timezone
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder import DocType
+from frappe.query_builder.functions import Max
+from frappe.utils import now_datetime
+
+
+class StripeWebhookEvent(Document):
+	pass
+
+
+def get_event_created_at(event):
+	created = event.get("created")
+	if not created:
+		return None
+	return datetime.fromtimestamp(created, timezone.utc).replace(tzinfo=None)
+
+
+def insert_webhook_events(events):
+	"""
+	Store raw Stripe events in a single INSERT. Events that are already stored
+	(Stripe retries and duplicate deliveries) are skipped by the primary key.
+	"""
+	now = now_datetime()
+	user = frappe.session.user
+
+	values = [
+		(
+			event["id"],
+			event["id"],
+			event.get("type"),
+			((event.get("data") or {}).get("object") or {}).get("id"),
+			"Pending",
+			get_event_created_at(event),
+			now,
+			json.dumps(event),
+			now,
+			now,
+			user,
+			user,
+		)
+		for event in events
+		if event.get("id")
+	]
+
+	frappe.db.bulk_insert(
+		"Stripe Webhook Event",
+		[
+			"name",
+			"event_id",
+			"event_type",
+			"resource_id",
+			"status",
+			"event_created_at",
+			"received_on",
+			"payload",
+			"creation",
+			"modified",
+			"owner",
+			"modified_by",
+		],
+		values,
+		ignore_duplicates=True,
+	)
+
+	return len(values)
+
+
+def get_pending_events(limit=500):
+	"""Oldest pending events first, so state changes are applied in the order they happened"""
+	return frappe.get_all(
+		"Stripe Webhook Event",
+		filters={"status": "Pending"},
+		fields=["name", "event_type", "resource_id", "event_created_at", "payload"],
+		order_by="event_created_at asc, name asc",
+		limit=limit,
+	)
+
+
+def get_last_applied(resource_ids):
+	"""created timestamp of the newest processed event per Stripe object"""
+	if not resource_ids:
+		return {}
+
+	Event = DocType("Stripe Webhook Event")
+	return dict(
+		(
+			frappe.qb.from_(Event)
+			.select(Event.resource_id, Max(Event.event_created_at))
+			.where(Event.resource_id.isin(list(resource_ids)))
+			.where(Event.status == "Processed")
+			.groupby(Event.resource_id)
+		).run()
+	)
+
+
+def set_event_status(events, status, error=None):
+	"""Mark a set of events as processed or failed in one UPDATE"""
+	if not events:
+		return
+
+	Event = DocType("Stripe Webhook Event")
+	(
+		frappe.qb.update(Event)
+		.set(Event.status, status)
+		.set(Event.processed_on, now_datetime())
+		.set(Event.error, error)
+		.where(Event.name.isin(events))
+	).run()
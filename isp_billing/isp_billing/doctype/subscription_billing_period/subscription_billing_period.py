@@ -0,0 +1,26 @@
+# Copyright (c) 2026, MSS and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class SubscriptionBillingPeriod(Document):
+	pass
+
+
+def on_doctype_update():
+	# one ledger entry per service row and period: "already billed?" is an index lookup
+	frappe.db.add_unique(
+		"Subscription Billing Period", ["service", "period_start"], constraint_name="unique_service_period"
+	)
+
+
+def get_billed_periods(service):
+	"""(period_start, billing_date) of every ledger entry of a service row"""
+	return frappe.get_all(
+		"Subscription Billing Period",
+		filters={"service": service},
+		fields=["period_start", "billing_date"],
+		as_list=True,
+	)
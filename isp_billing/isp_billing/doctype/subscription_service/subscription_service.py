@@ -1,9 +1,116 @@
 # Copyright (c) 2025, MSS and contributors
 # For license information, please see license.txt
 
-# import frappe
 from frappe.model.document import Document
+from frappe.utils import add_days, add_months, cint, getdate, today
 
 
 class SubscriptionService(Document):
 	pass
+
+
+def get_charge_periods(pay_period):
+	"""Number of periods charged on one invoice, e.g. "3 Charge Periods" -> 3"""
+	if pay_period and pay_period[0].isdigit():
+		return cint(pay_period.split()[0]) or 1
+	return 1
+
+
+def get_billing_interval(service):
+	"""Months covered by one invoice of a service row"""
+	return max(cint(service.no_of_month), 1) * get_charge_periods(service.pay_period)
+
+
+def get_period_index(service, date):
+	"""Index of the billing period of a service row that contains `date`"""
+	start = getdate(service.billing_start_date)
+	date = getdate(date)
+	if date < start:
+		return 0
+
+	months = (date.year - start.year) * 12 + date.month - start.month
+	index = months // get_billing_interval(service)
+
+	# a period that starts later in the month has not begun yet
+	if getdate(get_period_start(service, index)) > date:
+		index -= 1
+
+	return max(index, 0)
+
+
+def get_period_start(service, index):
+	"""Start date of the n-th billing period, always counted from billing_start_date"""
+	return add_months(getdate(service.billing_start_date), index * get_billing_interval(service))
+
+
+def get_billing_date(service, index):
+	"""
+	Date the invoice for the n-th period falls due, or None once the period starts
+	after billing_end_date. Post Paid rows are billed at the end of the period,
+	everything else at its start.
+	"""
+	period_start = getdate(get_period_start(service, index))
+	if service.billing_end_date and period_start > getdate(service.billing_end_date):
+		return None
+
+	if service.pay_period == "Post Paid":
+		return getdate(get_period_start(service, index + 1))
+
+	return period_start
+
+
+def get_billing_period_start(service, billing_date=None):
+	"""Start of the period billed on `billing_date` (the row's next_billing_date by default)"""
+	index = get_period_index(service, billing_date or service.next_billing_date)
+	if service.pay_period == "Post Paid":
+		index -= 1
+
+	return getdate(get_period_start(service, max(index, 0)))
+
+
+def get_billing_period_end(service, period_start):
+	"""Last day of the period that starts on period_start"""
+	return add_days(get_period_start(service, get_period_index(service, period_start) + 1), -1)
+
+
+def get_next_billing_date(service, billed_period_start=None):
+	"""Next date a service row is due, given the start of the period it was last billed for"""
+	if not service.billing_start_date:
+		return None
+
+	if not billed_period_start:
+		return get_billing_date(service, 0)
+
+	return get_billing_date(service, get_period_index(service, billed_period_start) + 1)
+
+
+def get_catch_up_billing_date(service, billing_date, date=None):
+	"""
+	`billing_date`, or the billing date of the period that contains `date` (today
+	by default) when billing_date is older: periods that have already gone by
+	are not back-billed, the row starts on the current one.
+	"""
+	current = get_billing_date(service, get_period_index(service, date or today()))
+	if not billing_date or not current or getdate(billing_date) < current:
+		return current
+
+	return getdate(billing_date)
+
+
+def skip_billed_periods(service, billing_date, billed):
+	"""
+	First billing date from `billing_date` on whose period has not been billed yet.
+	`billed` holds the (period_start, billing_date) pairs of the row's Subscription
+	Billing Period entries: a row due on a billed date is never picked up by the
+	billing run, and one due for a billed period can never claim it.
+	"""
+	period_starts = {getdate(period_start) for period_start, _ in billed}
+	billing_dates = {getdate(date) for _, date in billed}
+
+	while billing_date and (
+		getdate(billing_date) in billing_dates
+		or get_billing_period_start(service, billing_date) in period_starts
+	):
+		billing_date = get_next_billing_date(service, get_billing_period_start(service, billing_date))
+
+	return billing_date
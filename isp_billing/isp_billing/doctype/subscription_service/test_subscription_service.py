@@ -0,0 +1,121 @@
+# Copyright (c) 2026, MSS and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import getdate
+
+from isp_billing.isp_billing.doctype.subscription_service.subscription_service import (
+	get_billing_date,
+	get_billing_period_start,
+	get_catch_up_billing_date,
+	get_next_billing_date,
+	get_period_index,
+	skip_billed_periods,
+)
+
+
+def make_service(**kwargs):
+	return frappe._dict(
+		{
+			"billing_start_date": "2026-01-01",
+			"billing_end_date": None,
+			"pay_period": "Default",
+			"no_of_month": 1,
+			"next_billing_date": None,
+			**kwargs,
+		}
+	)
+
+
+class TestSubscriptionService(FrappeTestCase):
+	def test_period_index(self):
+		svc = make_service(billing_start_date="2026-01-15")
+
+		self.assertEqual(get_period_index(svc, "2025-12-01"), 0)
+		self.assertEqual(get_period_index(svc, "2026-01-15"), 0)
+		self.assertEqual(get_period_index(svc, "2026-02-14"), 0)
+		self.assertEqual(get_period_index(svc, "2026-02-15"), 1)
+		self.assertEqual(get_period_index(svc, "2027-01-20"), 12)
+
+	def test_month_end_start(self):
+		svc = make_service(billing_start_date="2026-01-31")
+
+		# periods are counted from the start date, so a short month does not shift the rest
+		self.assertEqual(get_billing_date(svc, 1), getdate("2026-02-28"))
+		self.assertEqual(get_billing_date(svc, 2), getdate("2026-03-31"))
+		self.assertEqual(get_period_index(svc, "2026-02-27"), 0)
+		self.assertEqual(get_period_index(svc, "2026-02-28"), 1)
+		self.assertEqual(get_next_billing_date(svc, "2026-02-28"), getdate("2026-03-31"))
+
+	def test_charge_periods(self):
+		svc = make_service(pay_period="3 Charge Periods")
+
+		self.assertEqual(get_billing_date(svc, 1), getdate("2026-04-01"))
+		self.assertEqual(get_period_index(svc, "2026-03-31"), 0)
+		self.assertEqual(get_next_billing_date(svc, "2026-01-01"), getdate("2026-04-01"))
+
+	def test_first_billing_date(self):
+		self.assertEqual(get_next_billing_date(make_service()), getdate("2026-01-01"))
+		self.assertIsNone(get_next_billing_date(make_service(billing_start_date=None)))
+
+	def test_post_paid(self):
+		svc = make_service(billing_start_date="2026-01-15", pay_period="Post Paid")
+
+		# billed when the period ends, for the period that just ended
+		self.assertEqual(get_next_billing_date(svc), getdate("2026-02-15"))
+		self.assertEqual(get_billing_period_start(svc, "2026-02-15"), getdate("2026-01-15"))
+		self.assertEqual(get_next_billing_date(svc, "2026-01-15"), getdate("2026-03-15"))
+
+	def test_end_date_mid_period(self):
+		svc = make_service(billing_end_date="2026-03-15")
+
+		# the period that contains the end date is still billed, the next one is not
+		self.assertEqual(get_billing_date(svc, 2), getdate("2026-03-01"))
+		self.assertIsNone(get_billing_date(svc, 3))
+		self.assertIsNone(get_next_billing_date(svc, "2026-03-01"))
+
+		svc.pay_period = "Post Paid"
+		self.assertEqual(get_next_billing_date(svc, "2026-02-01"), getdate("2026-04-01"))
+		self.assertIsNone(get_next_billing_date(svc, "2026-03-01"))
+
+	def test_catch_up_billing_date(self):
+		svc = make_service(billing_start_date="2024-01-15")
+
+		# two years of periods gone by: start on the one that contains the date
+		self.assertEqual(get_catch_up_billing_date(svc, "2024-01-15", "2026-03-20"), getdate("2026-03-15"))
+		self.assertEqual(get_catch_up_billing_date(svc, "2026-04-15", "2026-03-20"), getdate("2026-04-15"))
+		self.assertEqual(get_catch_up_billing_date(svc, None, "2026-03-20"), getdate("2026-03-15"))
+
+		svc.pay_period = "Post Paid"
+		self.assertEqual(get_catch_up_billing_date(svc, "2024-02-15", "2026-03-20"), getdate("2026-04-15"))
+
+		svc.billing_end_date = "2025-12-31"
+		self.assertIsNone(get_catch_up_billing_date(svc, "2024-02-15", "2026-03-20"))
+
+	def test_skip_billed_periods(self):
+		svc = make_service()
+		billed = [
+			(getdate("2026-01-01"), getdate("2026-01-01")),
+			(getdate("2026-02-01"), getdate("2026-02-01")),
+		]
+
+		self.assertEqual(skip_billed_periods(svc, "2026-01-01", billed), getdate("2026-03-01"))
+		self.assertEqual(getdate(skip_billed_periods(svc, "2026-05-01", billed)), getdate("2026-05-01"))
+		self.assertIsNone(skip_billed_periods(svc, None, billed))
+
+	def test_skip_billed_periods_after_schedule_edit(self):
+		# January was billed monthly, then the row moved to quarterly billing: the
+		# recomputed date lands back on the billed January period
+		svc = make_service(pay_period="3 Charge Periods")
+		billed = [(getdate("2026-01-01"), getdate("2026-01-01"))]
+
+		recomputed = get_billing_date(svc, get_period_index(svc, "2026-02-01"))
+		self.assertEqual(recomputed, getdate("2026-01-01"))
+		self.assertEqual(skip_billed_periods(svc, recomputed, billed), getdate("2026-04-01"))
+
+	def test_skip_billed_periods_post_paid(self):
+		svc = make_service(billing_start_date="2026-01-15", pay_period="Post Paid")
+		billed = [(getdate("2026-01-15"), getdate("2026-02-15"))]
+
+		self.assertEqual(skip_billed_periods(svc, "2026-02-15", billed), getdate("2026-03-15"))
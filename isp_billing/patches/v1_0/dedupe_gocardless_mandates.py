@@ -0,0 +1,32 @@
+import frappe
+
+
+def execute():
+	"""
+	Keep one GoCardless Mandates row per mandate_id, the most recently modified,
+	so the column can become unique. Redelivered webhooks used to insert the
+	same mandate more than once.
+	"""
+	if not frappe.db.table_exists("GoCardless Mandates"):
+		return
+
+	frappe.db.sql("update `tabGoCardless Mandates` set mandate_id = null where mandate_id = ''")
+
+	duplicates = frappe.db.sql(
+		"""
+		select mandate_id from `tabGoCardless Mandates`
+		where mandate_id is not null
+		group by mandate_id
+		having count(*) > 1
+		""",
+		pluck=True,
+	)
+
+	for mandate_id in duplicates:
+		names = frappe.get_all(
+			"GoCardless Mandates",
+			filters={"mandate_id": mandate_id},
+			order_by="modified desc",
+			pluck="name",
+		)
+		frappe.db.delete("GoCardless Mandates", {"name": ["in", names[1:]]})
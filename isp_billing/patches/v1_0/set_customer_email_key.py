@@ -0,0 +1,18 @@
+import frappe
+from frappe.query_builder import DocType
+from frappe.query_builder.functions import Lower, Trim
+from frappe.utils.fixtures import sync_fixtures
+
+
+def execute():
+	"""Fill the normalised email key of existing Customers in one UPDATE"""
+	# fixtures are synced after the patches, so create the custom field now
+	sync_fixtures("isp_billing")
+
+	Customer = DocType("Customer")
+
+	(
+		frappe.qb.update(Customer)
+		.set(Customer.custom_email_key, Lower(Trim(Customer.custom_email)))
+		.where(Customer.custom_email.isnotnull())
+	).run()
@@ -0,0 +1,42 @@
+import frappe
+from frappe.query_builder import DocType
+from frappe.utils import today
+
+from isp_billing.isp_billing.doctype.subscription_service.subscription_service import (
+	get_billing_date,
+	get_period_index,
+)
+
+
+def execute():
+	"""
+	Schedule existing service rows on the period that contains today. Rows that
+	already carry this period's invoice move on to the next one, so the upgrade
+	neither re-bills them nor back-bills old periods.
+	"""
+	Service = DocType("Subscription Service")
+
+	rows = (
+		frappe.qb.from_(Service)
+		.select(
+			Service.name,
+			Service.billing_start_date,
+			Service.billing_end_date,
+			Service.pay_period,
+			Service.no_of_month,
+			Service.sales_invoice_id,
+		)
+		.where(Service.parenttype == "CLI Subscription")
+		.where(Service.billing_start_date.isnotnull())
+		.where(Service.next_billing_date.isnull())
+	).run(as_dict=True)
+
+	updates = {}
+	for row in rows:
+		index = get_period_index(row, today())
+		if row.sales_invoice_id and row.pay_period != "Post Paid":
+			index += 1
+
+		updates[row.name] = {"next_billing_date": get_billing_date(row, index)}
+
+	frappe.db.bulk_update("Subscription Service", updates, update_modified=False)